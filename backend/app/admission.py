@@ -0,0 +1,106 @@
+import itertools
+import os
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from fastapi import HTTPException, status
+from app.core.config import settings
+from app.datasets import cached_shape
+
+# Rough bytes per cell used to size spreadsheets that are not parsed yet
+_BYTES_PER_CELL = 16
+# A search converts every scanned cell to text and matches it, several times the work of a page read
+_SEARCH_FACTOR = 4
+
+
+def estimate_cost(file_path: str, search: str | None = None, col: str | None = None) -> int:
+    """Estimates the work of a request in scanned cells (rows x columns)."""
+    shape = cached_shape(file_path)
+    cost = 1
+    if shape:
+        rows, columns = shape
+    else:
+        # Parsing the file is paid before anything else
+        try:
+            cost = os.path.getsize(file_path) // _BYTES_PER_CELL
+        except OSError:
+            cost = 1
+        rows, columns = cost, 1
+    if search:
+        cost += rows * (1 if col else columns) * _SEARCH_FACTOR
+    return max(cost, 1)
+
+
+class Ticket:
+    def __init__(self, user_id: int, cost: int, key=None, generation: int = 0):
+        self.user_id = user_id
+        self.cost = cost
+        self.key = key
+        self.generation = generation
+
+
+class AdmissionController:
+    """Bounds the work running in this process instead of queueing it.
+
+    Each user may run ``per_user`` heavy requests at a time and the cost of all running
+    requests must fit in ``budget``. A request is always admitted when nothing else is
+    running, so a single oversized spreadsheet can still be served. Searches carry a
+    supersede key; a newer search with the same key makes older ones stop at their next
+    checkpoint and no longer count against the user's limit.
+    """
+
+    def __init__(self, budget: int, per_user: int, retry_after: int):
+        self.budget = budget
+        self.per_user = per_user
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._cost_in_flight = 0
+        self._tickets: dict[int, list[Ticket]] = defaultdict(list)
+        self._generations: dict = {}
+        # Generations never repeat, so a finished key can be forgotten safely
+        self._next_generation = itertools.count(1)
+
+    def _reject(self, status_code: int, detail: str):
+        raise HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": str(self.retry_after)})
+
+    def is_superseded(self, ticket: Ticket) -> bool:
+        return ticket.key is not None and self._generations.get(ticket.key) != ticket.generation
+
+    def checkpoint(self, ticket: Ticket) -> None:
+        if self.is_superseded(ticket):
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Superseded by a newer request")
+
+    @contextmanager
+    def admit(self, user_id: int, cost: int, supersede_key=None):
+        with self._lock:
+            active = [
+                t for t in self._tickets.get(user_id, [])
+                if t.key is None or (t.key != supersede_key and not self.is_superseded(t))
+            ]
+            if len(active) >= self.per_user:
+                self._reject(status.HTTP_429_TOO_MANY_REQUESTS, "Too many concurrent requests")
+            if self._cost_in_flight and self._cost_in_flight + cost > self.budget:
+                self._reject(status.HTTP_503_SERVICE_UNAVAILABLE, "Server busy")
+            generation = next(self._next_generation)
+            if supersede_key is not None:
+                self._generations[supersede_key] = generation
+            ticket = Ticket(user_id, cost, supersede_key, generation)
+            self._tickets[user_id].append(ticket)
+            self._cost_in_flight += cost
+        try:
+            yield ticket
+        finally:
+            with self._lock:
+                self._cost_in_flight -= cost
+                self._tickets[user_id].remove(ticket)
+                if not self._tickets[user_id]:
+                    del self._tickets[user_id]
+                if supersede_key is not None and self._generations.get(supersede_key) == generation:
+                    del self._generations[supersede_key]
+
+
+controller = AdmissionController(
+    budget=settings.admission_budget_cells,
+    per_user=settings.admission_per_user,
+    retry_after=settings.admission_retry_after_seconds,
+)
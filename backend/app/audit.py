@@ -0,0 +1,164 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import insert
+from app import models
+from app.core.config import settings
+from app.db import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# Access events are buffered in memory and written in bulk by a background thread, so
+# the request path never waits for the database. When the buffer is full or the
+# database is unavailable, events are appended to a local spill file and replayed later.
+# The spill file is shared by every worker process, so it is guarded by file locks.
+
+_buffer: deque = deque()
+_lock = threading.Lock()
+_wake = threading.Event()
+_stop = threading.Event()
+_thread: threading.Thread | None = None
+stats = {"recorded": 0, "flushed": 0, "spilled": 0, "dropped": 0}
+
+
+def record(user_id: int, spreadsheet_id: int, action: str, detail: str | None = None) -> None:
+    event = {
+        "user_id": user_id,
+        "spreadsheet_id": spreadsheet_id,
+        "action": action,
+        "detail": detail[:255] if detail else None,
+        "created_at": datetime.utcnow(),
+    }
+    with _lock:
+        stats["recorded"] += 1
+        full = len(_buffer) >= settings.audit_buffer_max
+        if not full:
+            _buffer.append(event)
+            size = len(_buffer)
+    if full:
+        _spill([event])
+    elif size >= settings.audit_batch_size:
+        _wake.set()
+
+
+@contextmanager
+def _file_lock(suffix: str, blocking: bool = True):
+    """Yields whether the lock was taken; without ``blocking`` it is skipped when held."""
+    with open(f"{settings.audit_spill_path}{suffix}", "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+
+
+def _write_events(path: str, events: list[dict], mode: str) -> None:
+    with open(path, mode, encoding="utf-8") as f:
+        for event in events:
+            f.write(json.dumps({**event, "created_at": event["created_at"].isoformat()}) + "\n")
+
+
+def _spill(events: list[dict]) -> None:
+    try:
+        with _file_lock(".lock"):
+            _write_events(settings.audit_spill_path, events, "a")
+        with _lock:
+            stats["spilled"] += len(events)
+    except OSError:
+        with _lock:
+            stats["dropped"] += len(events)
+
+
+def _insert(events: list[dict]) -> None:
+    db = SessionLocal()
+    try:
+        db.execute(insert(models.AuditEvent), events)
+        db.commit()
+    finally:
+        db.close()
+
+
+def _take_batch() -> list[dict]:
+    with _lock:
+        count = min(len(_buffer), settings.audit_batch_size)
+        return [_buffer.popleft() for _ in range(count)]
+
+
+def flush() -> None:
+    while batch := _take_batch():
+        try:
+            _insert(batch)
+        except Exception:
+            logger.exception("Could not write %d audit events, spilling them", len(batch))
+            _spill(batch)
+            return
+        with _lock:
+            stats["flushed"] += len(batch)
+
+
+def _replay_spill() -> None:
+    with _file_lock(".replay.lock", blocking=False) as locked:
+        if not locked:
+            # Another worker is replaying the spill
+            return
+        _replay_locked()
+
+
+def _replay_locked() -> None:
+    replay_path = f"{settings.audit_spill_path}.replay"
+    with _file_lock(".lock"):
+        if not os.path.exists(replay_path):
+            if not os.path.exists(settings.audit_spill_path):
+                return
+            os.replace(settings.audit_spill_path, replay_path)
+    events = []
+    with open(replay_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+                event["created_at"] = datetime.fromisoformat(event["created_at"])
+                events.append(event)
+            except (ValueError, KeyError):
+                continue
+    for start in range(0, len(events), settings.audit_batch_size):
+        try:
+            _insert(events[start:start + settings.audit_batch_size])
+        except Exception:
+            # Only what was not written is retried on the next cycle
+            _write_events(replay_path, events[start:], "w")
+            raise
+    os.remove(replay_path)
+    with _lock:
+        stats["flushed"] += len(events)
+
+
+def _run() -> None:
+    while not _stop.is_set():
+        _wake.wait(timeout=settings.audit_flush_seconds)
+        _wake.clear()
+        flush()
+        try:
+            _replay_spill()
+        except Exception:
+            logger.exception("Could not replay spilled audit events")
+
+
+def start() -> None:
+    global _thread
+    _stop.clear()
+    _thread = threading.Thread(target=_run, name="audit-writer", daemon=True)
+    _thread.start()
+
+
+def stop() -> None:
+    _stop.set()
+    _wake.set()
+    if _thread is not None:
+        _thread.join(timeout=settings.audit_flush_seconds)
+    flush()
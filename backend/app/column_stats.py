@@ -0,0 +1,158 @@
+import datetime
+import json
+import os
+import tempfile
+from typing import TYPE_CHECKING
+from app.core.config import settings
+from app.datasets import STATS_SUFFIX, load_dataframe, sidecar_path
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# Column statistics are computed once per file version and stored next to its Arrow file,
+# so the schema of a spreadsheet can be served without parsing it again.
+
+# Size of the k-minimum-values sketch used for distinct counts
+_KMV_SIZE = 1024
+
+
+_TYPES_BY_KIND = {"b": "boolean", "i": "integer", "u": "integer", "f": "number", "M": "datetime"}
+
+
+def _column_type(series: "pd.Series") -> str:
+    # dtype.kind is defined for both numpy and Arrow-backed columns
+    return _TYPES_BY_KIND.get(series.dtype.kind, "text")
+
+
+def _json_value(value):
+    if value is None:
+        return None
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if hasattr(value, "item"):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+    if isinstance(value, (int, float, bool, str)):
+        return value
+    return str(value)
+
+
+def approx_distinct(series: "pd.Series") -> int:
+    """Estimates distinct non-null values with a k-minimum-values sketch over 64-bit hashes."""
+    import numpy as np
+    import pandas as pd
+
+    hashes = pd.util.hash_pandas_object(series.dropna(), index=False).to_numpy()
+    if len(hashes) <= 4 * _KMV_SIZE:
+        return int(len(np.unique(hashes)))
+    threshold = np.partition(hashes, 4 * _KMV_SIZE)[4 * _KMV_SIZE]
+    smallest = np.unique(hashes[hashes <= threshold])
+    if len(smallest) < _KMV_SIZE:
+        # Few distinct values, the exact count is cheap
+        return int(len(np.unique(hashes)))
+    kth = float(smallest[_KMV_SIZE - 1]) / float(2**64)
+    return int((_KMV_SIZE - 1) / kth)
+
+
+def _min_max(series: "pd.Series"):
+    import pandas as pd
+
+    values = series.dropna()
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        # Categories are unordered, compare the values themselves
+        values = values.astype(values.dtype.categories.dtype)
+    if values.empty:
+        return None, None
+    try:
+        return _json_value(values.min()), _json_value(values.max())
+    except TypeError:
+        # Mixed types cannot be ordered
+        return None, None
+
+
+def _column_stats(name, series: "pd.Series") -> dict:
+    minimum, maximum = _min_max(series)
+    return {
+        "name": str(name),
+        "type": _column_type(series),
+        "null_count": int(series.isna().sum()),
+        "min": minimum,
+        "max": maximum,
+        "approx_distinct": approx_distinct(series),
+    }
+
+
+def compute(df: "pd.DataFrame") -> dict:
+    columns = [_column_stats(name, df[name]) for name in df.columns]
+    return {"row_count": int(len(df)), "columns": columns}
+
+
+def _pick(choose, previous, appended):
+    if previous is None or appended is None:
+        return appended if previous is None else previous
+    try:
+        return choose(previous, appended)
+    except TypeError:
+        return None
+
+
+def _merge_column(previous: dict, series: "pd.Series", appended: "pd.Series") -> dict:
+    if previous["type"] != _column_type(series):
+        # The appended rows changed the column type, its old min/max do not compare
+        return _column_stats(previous["name"], series)
+    minimum, maximum = _min_max(appended)
+    return {
+        **previous,
+        "null_count": previous["null_count"] + int(appended.isna().sum()),
+        "min": _pick(min, previous["min"], minimum),
+        "max": _pick(max, previous["max"], maximum),
+        # The sketch is not stored, hashing the column is the cheap part of the statistics
+        "approx_distinct": approx_distinct(series),
+    }
+
+
+def extend(old_path: str, new_path: str) -> dict:
+    """Statistics of ``new_path``, which is ``old_path`` plus appended rows, merged from the old ones."""
+    previous = load(old_path)
+    df = load_dataframe(new_path)
+    if (
+        previous is None
+        or previous["row_count"] > len(df)
+        or [c["name"] for c in previous["columns"]] != [str(c) for c in df.columns]
+    ):
+        return ensure(new_path)
+    start = previous["row_count"]
+    columns = [
+        _merge_column(stats, df[name], df[name].iloc[start:])
+        for stats, name in zip(previous["columns"], df.columns)
+    ]
+    stats = {"row_count": int(len(df)), "columns": columns}
+    save(new_path, stats)
+    return stats
+
+
+def save(file_path: str, stats: dict) -> None:
+    path = sidecar_path(file_path, STATS_SUFFIX)
+    os.makedirs(settings.parsed_dir, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=settings.parsed_dir, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(stats, f, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+
+def load(file_path: str) -> dict | None:
+    try:
+        with open(sidecar_path(file_path, STATS_SUFFIX)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def ensure(file_path: str) -> dict:
+    """Returns the stored statistics, computing them for files ingested before they existed."""
+    stats = load(file_path)
+    if stats is None:
+        stats = compute(load_dataframe(file_path))
+        save(file_path, stats)
+    return stats
@@ -11,6 +11,28 @@ class Settings(BaseModel):
     jwt_algorithm: str = "HS256"
     access_token_exp_minutes: int = 60 * 24
     upload_dir: str = os.getenv("UPLOAD_DIR", "/app/uploads")
+    parsed_dir: str = os.getenv("PARSED_DIR", os.path.join(os.getenv("UPLOAD_DIR", "/app/uploads"), ".parsed"))
+    worker_heartbeat_seconds: int = int(os.getenv("WORKER_HEARTBEAT_SECONDS", "15"))
+    warmup_spreadsheets: int = int(os.getenv("WARMUP_SPREADSHEETS", "0"))
+    dataset_cache_size: int = int(os.getenv("DATASET_CACHE_SIZE", "8"))
+    result_cache_size: int = int(os.getenv("RESULT_CACHE_SIZE", "256"))
+    retired_file_grace_seconds: int = int(os.getenv("RETIRED_FILE_GRACE_SECONDS", "300"))
+    admission_budget_cells: int = int(os.getenv("ADMISSION_BUDGET_CELLS", "50000000"))
+    admission_per_user: int = int(os.getenv("ADMISSION_PER_USER", "2"))
+    admission_retry_after_seconds: int = int(os.getenv("ADMISSION_RETRY_AFTER_SECONDS", "2"))
+    process_pool_workers: int = int(os.getenv("PROCESS_POOL_WORKERS", "0"))
+    process_pool_max_tasks_per_child: int = int(os.getenv("PROCESS_POOL_MAX_TASKS_PER_CHILD", "200"))
+    process_pool_timeout_seconds: float = float(os.getenv("PROCESS_POOL_TIMEOUT_SECONDS", "30"))
+    storage_reconcile_seconds: int = int(os.getenv("STORAGE_RECONCILE_SECONDS", "900"))
+    storage_orphan_grace_seconds: int = int(os.getenv("STORAGE_ORPHAN_GRACE_SECONDS", "3600"))
+    search_all_threads: int = int(os.getenv("SEARCH_ALL_THREADS", "4"))
+    search_all_budget_seconds: float = float(os.getenv("SEARCH_ALL_BUDGET_SECONDS", "5"))
+    server_timing: bool = os.getenv("SERVER_TIMING", "false").lower() in ("1", "true", "yes")
+    slow_request_ms: float = float(os.getenv("SLOW_REQUEST_MS", "0"))
+    audit_batch_size: int = int(os.getenv("AUDIT_BATCH_SIZE", "500"))
+    audit_flush_seconds: float = float(os.getenv("AUDIT_FLUSH_SECONDS", "5"))
+    audit_buffer_max: int = int(os.getenv("AUDIT_BUFFER_MAX", "20000"))
+    audit_spill_path: str = os.getenv("AUDIT_SPILL_PATH", os.path.join(os.getenv("UPLOAD_DIR", "/app/uploads"), ".audit-spill.jsonl"))
     smtp_host: str = os.getenv("SMTP_HOST", "smtp.office365.com")
     smtp_port: int = int(os.getenv("SMTP_PORT", "587"))
     smtp_user: str = os.getenv("SMTP_USER", "matheus.cabrerisso@jacuzzi.com.br")
@@ -0,0 +1,421 @@
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import Counter, OrderedDict
+from typing import TYPE_CHECKING
+from app.core.config import settings
+from app.timing import stage
+
+# pandas and pyarrow take seconds to import, so they are imported on first use
+if TYPE_CHECKING:
+    import pandas as pd
+    import pyarrow as pa
+
+CHUNK_ROWS = 5000
+# Text columns with at most this share of distinct values are stored as categoricals
+CATEGORY_MAX_RATIO = 0.5
+ARROW_SUFFIX = ".arrow"
+STATS_SUFFIX = ".stats.json"
+SEARCH_SUFFIX = ".search.arrow"
+SIDECAR_SUFFIXES = (ARROW_SUFFIX, STATS_SUFFIX, SEARCH_SUFFIX)
+
+# Parsed frames keyed by file path. Every version of a spreadsheet is written to a
+# new path, so an entry never goes stale while its file exists.
+#
+# Each parsed frame is also persisted as an Arrow IPC file under settings.parsed_dir and
+# loaded through a memory map, so every worker process serving the app shares the same
+# page-cache copy instead of holding its own. Removing the Arrow file is how one worker
+# invalidates the entry in all the others.
+_frames: "OrderedDict[str, pd.DataFrame]" = OrderedDict()
+_frames_lock = threading.Lock()
+# Derived results (aggregations, indexes) keyed by file path, then by query
+_results: "OrderedDict[tuple, object]" = OrderedDict()
+# Loads since the last flush, merged into popularity.json to pick what to warm up on boot
+_hits: Counter = Counter()
+
+
+def read_dataframe(file_path: str) -> "pd.DataFrame":
+    import pandas as pd
+
+    ext = os.path.splitext(file_path)[1].lower()
+    with stage("parse"):
+        if ext == ".csv":
+            return pd.read_csv(file_path)
+        return pd.read_excel(file_path)
+
+
+def read_columns(file_path: str) -> list:
+    """Column names of the spreadsheet, read from its header without parsing the rows."""
+    import pandas as pd
+    import pyarrow as pa
+
+    with _frames_lock:
+        df = _frames.get(file_path)
+    if df is not None:
+        return list(df.columns)
+    try:
+        return pa.ipc.open_file(pa.memory_map(_arrow_path(file_path), "r")).schema.names
+    except FileNotFoundError:
+        pass
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext == ".csv":
+        columns = pd.read_csv(file_path, nrows=0).columns
+    else:
+        columns = pd.read_excel(file_path, nrows=0).columns
+    # Loaded frames come from Arrow files, which store every column name as text
+    return [str(column) for column in columns]
+
+
+def sidecar_path(file_path: str, suffix: str) -> str:
+    """Path of data derived from ``file_path``, shared by every spreadsheet using that blob."""
+    return os.path.join(settings.parsed_dir, f"{os.path.basename(file_path)}{suffix}")
+
+
+def _arrow_path(file_path: str) -> str:
+    return sidecar_path(file_path, ARROW_SUFFIX)
+
+
+def _compact_column(series: "pd.Series") -> "pd.Series":
+    import numpy as np
+    import pandas as pd
+
+    kind = series.dtype.kind
+    if kind == "i":
+        return pd.to_numeric(series, downcast="integer")
+    if kind == "u":
+        return pd.to_numeric(series, downcast="unsigned")
+    if kind == "f" and series.dtype.itemsize > 4:
+        narrow = series.astype(np.float32)
+        # Prices must keep their cents, so floats are only narrowed when no value changes
+        if (narrow.astype(series.dtype) == series)[series.notna()].all():
+            return narrow
+        return series
+    if series.dtype == object and pd.api.types.infer_dtype(series, skipna=True) == "string":
+        if series.nunique() <= CATEGORY_MAX_RATIO * len(series):
+            return series.astype("category")
+        return series.astype("string[pyarrow]")
+    return series
+
+
+def compact(df: "pd.DataFrame") -> "pd.DataFrame":
+    """Returns ``df`` with Arrow strings, categoricals for repeated text and narrowed numbers."""
+    import pandas as pd
+
+    if df.columns.empty:
+        return df
+    columns = [_compact_column(df.iloc[:, i]) for i in range(df.shape[1])]
+    compacted = pd.concat(columns, axis=1)
+    compacted.columns = df.columns
+    return compacted
+
+
+def _to_arrow_table(df: "pd.DataFrame") -> "pa.Table":
+    import pyarrow as pa
+
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Excel columns mixing numbers and text have no Arrow type; keep them as text
+        df = df.copy()
+        for column in df.columns:
+            if df[column].dtype == object:
+                df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def _write_arrow(arrow_path: str, df: "pd.DataFrame") -> str:
+    import pyarrow as pa
+
+    os.makedirs(settings.parsed_dir, exist_ok=True)
+    table = _to_arrow_table(df)
+    fd, temp_path = tempfile.mkstemp(dir=settings.parsed_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(temp_path, arrow_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return arrow_path
+
+
+def _map_arrow(arrow_path: str) -> "pd.DataFrame":
+    import pandas as pd
+    import pyarrow as pa
+
+    table = pa.ipc.open_file(pa.memory_map(arrow_path, "r")).read_all()
+    # ArrowDtype columns keep pointing at the mapped buffers instead of copying them.
+    # Dictionary columns become pandas categoricals, which only copy their small codes.
+    return table.to_pandas(types_mapper=lambda t: None if pa.types.is_dictionary(t) else pd.ArrowDtype(t))
+
+
+def _remember(file_path: str, df: "pd.DataFrame") -> None:
+    with _frames_lock:
+        _frames[file_path] = df
+        _frames.move_to_end(file_path)
+        while len(_frames) > settings.dataset_cache_size:
+            _frames.popitem(last=False)
+
+
+def _cached(file_path: str) -> "pd.DataFrame | None":
+    with _frames_lock:
+        df = _frames.get(file_path)
+        if df is None:
+            return None
+        if os.path.exists(_arrow_path(file_path)):
+            _frames.move_to_end(file_path)
+            return df
+        # Another worker invalidated it
+        del _frames[file_path]
+    return None
+
+
+def _mapped(file_path: str) -> "pd.DataFrame | None":
+    df = _cached(file_path)
+    if df is not None:
+        return df
+    try:
+        df = _map_arrow(_arrow_path(file_path))
+    except FileNotFoundError:
+        return None
+    _remember(file_path, df)
+    return df
+
+
+def cache_frame(file_path: str, df: "pd.DataFrame") -> "pd.DataFrame":
+    mapped = _map_arrow(_write_arrow(_arrow_path(file_path), compact(df)))
+    _remember(file_path, mapped)
+    return mapped
+
+
+def load_dataframe(file_path: str) -> "pd.DataFrame":
+    """Returns the parsed spreadsheet, shared between requests. Callers must not mutate it."""
+    with _frames_lock:
+        _hits[file_path] += 1
+    with stage("load"):
+        df = _mapped(file_path)
+        if df is not None:
+            return df
+        return cache_frame(file_path, read_dataframe(file_path))
+
+
+def cached_shape(file_path: str) -> tuple[int, int] | None:
+    """Returns (rows, columns) when the spreadsheet is already parsed in this process."""
+    with _frames_lock:
+        df = _frames.get(file_path)
+        return df.shape if df is not None else None
+
+
+def frame_memory(file_path: str) -> int | None:
+    """Bytes held by the parsed spreadsheet when it is loaded in this process."""
+    with _frames_lock:
+        df = _frames.get(file_path)
+    if df is None:
+        return None
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def memoize(file_path: str, key, compute):
+    """Returns ``compute()`` cached for this file version and ``key``."""
+    cache_key = (file_path, key)
+    with _frames_lock:
+        if cache_key in _results:
+            _results.move_to_end(cache_key)
+            return _results[cache_key]
+    result = compute()
+    with _frames_lock:
+        _results[cache_key] = result
+        while len(_results) > settings.result_cache_size:
+            _results.popitem(last=False)
+    return result
+
+
+def _load_or_build_derived(file_path: str, suffix: str, build) -> "pd.DataFrame":
+    arrow_path = sidecar_path(file_path, suffix)
+    try:
+        return _map_arrow(arrow_path)
+    except FileNotFoundError:
+        pass
+    return _map_arrow(_write_arrow(arrow_path, build(load_dataframe(file_path))))
+
+
+def save_derived_frame(file_path: str, suffix: str, df: "pd.DataFrame") -> None:
+    """Stores ``df`` as the ``suffix`` sidecar of this file version, read by load_derived_frame."""
+    _write_arrow(sidecar_path(file_path, suffix), df)
+
+
+def load_derived_frame(file_path: str, suffix: str, build) -> "pd.DataFrame":
+    """Returns ``build(frame)`` persisted as a memory-mapped Arrow sidecar of this file version."""
+    return memoize(file_path, ("derived", suffix), lambda: _load_or_build_derived(file_path, suffix, build))
+
+
+def evict(file_path: str) -> None:
+    with _frames_lock:
+        _frames.pop(file_path, None)
+        for cache_key in [k for k in _results if k[0] == file_path]:
+            del _results[cache_key]
+    for suffix in SIDECAR_SUFFIXES:
+        try:
+            os.remove(sidecar_path(file_path, suffix))
+        except OSError:
+            pass
+
+
+def sweep() -> int:
+    """Drops frames invalidated by other workers and returns how many remain."""
+    with _frames_lock:
+        for file_path in [p for p in _frames if not os.path.exists(_arrow_path(p))]:
+            del _frames[file_path]
+        gone = {k[0] for k in _results if not os.path.exists(k[0])}
+        for cache_key in [k for k in _results if k[0] in gone]:
+            del _results[cache_key]
+        return len(_frames)
+
+
+def _popularity_path() -> str:
+    return os.path.join(settings.parsed_dir, "popularity.json")
+
+
+def take_hits() -> dict:
+    """Returns and resets the loads counted since the last call."""
+    with _frames_lock:
+        delta = dict(_hits)
+        _hits.clear()
+    return delta
+
+
+def add_hits(delta: dict) -> None:
+    """Counts loads made elsewhere, such as in a pool child, with this process's own."""
+    with _frames_lock:
+        _hits.update(delta)
+
+
+def flush_hits() -> None:
+    delta = take_hits()
+    if not delta:
+        return
+    os.makedirs(settings.parsed_dir, exist_ok=True)
+    with open(_popularity_path(), "a+") as f:
+        # Several workers merge their counts into the same file
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            counts = Counter(json.loads(f.read() or "{}"))
+        except ValueError:
+            counts = Counter()
+        counts.update(delta)
+        # Replaced and deleted spreadsheets are never loaded again
+        counts = {path: n for path, n in counts.items() if os.path.exists(path)}
+        f.seek(0)
+        f.truncate()
+        json.dump(counts, f)
+
+
+def popular_paths(candidates: list[str], limit: int) -> list[str]:
+    """Returns the ``limit`` most loaded paths among ``candidates``."""
+    try:
+        with open(_popularity_path()) as f:
+            counts = json.load(f)
+    except (OSError, ValueError):
+        counts = {}
+    ranked = sorted(set(candidates), key=lambda p: counts.get(p, 0), reverse=True)
+    return [p for p in ranked if counts.get(p, 0) > 0][:limit]
+
+
+def append_rows(file_path: str, rows: "pd.DataFrame", new_path: str) -> "pd.DataFrame | None":
+    """Writes ``file_path`` plus ``rows`` to ``new_path`` without touching the original file.
+
+    CSV versions are extended by copying the previous bytes and appending only the new
+    lines. When the previous version is already parsed, the combined frame is derived
+    from it and returned so the caller can cache it instead of parsing the new file again.
+    """
+    import pandas as pd
+
+    ext = os.path.splitext(file_path)[1].lower()
+    previous = _mapped(file_path)
+
+    if ext == ".csv":
+        columns = list(previous.columns) if previous is not None else list(pd.read_csv(file_path, nrows=0).columns)
+        rows = rows.reindex(columns=columns)
+        shutil.copyfile(file_path, new_path)
+        with open(new_path, "rb+") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+            else:
+                needs_newline = False
+            f.write((("\n" if needs_newline else "") + rows.to_csv(index=False, header=False)).encode("utf-8"))
+    else:
+        if previous is None:
+            previous = read_dataframe(file_path)
+        rows = rows.reindex(columns=list(previous.columns))
+        combined = pd.concat([previous, rows], ignore_index=True)
+        combined.to_excel(new_path, index=False)
+        return combined
+
+    if previous is None:
+        return None
+    return pd.concat([previous, rows], ignore_index=True)
+
+
+def _excel_columns(header: tuple) -> list[str]:
+    # Mirrors the column names pd.read_excel produces for blank and repeated headers
+    columns = []
+    seen: dict[str, int] = {}
+    for i, value in enumerate(header):
+        name = f"Unnamed: {i}" if value is None else str(value)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        columns.append(name)
+    return columns
+
+
+def _iter_xlsx_chunks(file_path: str, chunksize: int):
+    import pandas as pd
+    from openpyxl import load_workbook
+
+    wb = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = _excel_columns(header)
+        batch = []
+        yielded = False
+        for row in rows:
+            if all(value is None for value in row):
+                continue
+            batch.append(row[:len(columns)])
+            if len(batch) >= chunksize:
+                yield pd.DataFrame(batch, columns=columns)
+                yielded = True
+                batch = []
+        if batch or not yielded:
+            yield pd.DataFrame(batch, columns=columns)
+    finally:
+        wb.close()
+
+
+def iter_dataframe_chunks(file_path: str, chunksize: int = CHUNK_ROWS):
+    """Yields the spreadsheet as consecutive DataFrames of at most ``chunksize`` rows."""
+    import pandas as pd
+
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext == ".csv":
+        yield from pd.read_csv(file_path, chunksize=chunksize)
+    elif ext == ".xlsx":
+        yield from _iter_xlsx_chunks(file_path, chunksize)
+    else:
+        # openpyxl cannot stream legacy .xls files
+        df = read_dataframe(file_path)
+        for start in range(0, max(len(df), 1), chunksize):
+            yield df.iloc[start:start + chunksize]
@@ -1,12 +1,55 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy import func
 from sqlalchemy.orm import Session
-from app import models
+from app import audit, models, processing, reconciler
 from app.constants import UF_CODES
+from app.datasets import flush_hits
 from app.db import SessionLocal
-from app.routers import auth, admin, spreadsheets
+from app.routers import auth, admin, health, spreadsheets
+from app.timing import ServerTimingMiddleware, TimedJSONResponse
+from app.warmup import start_warmup
+from app.workers import start_heartbeat
 
-app = FastAPI(title="Portal Clientes")
+
+def ensure_state_access_levels():
+    db: Session = SessionLocal()
+    try:
+        # Fast path: a single COUNT when every UF level already exists
+        present = (
+            db.query(func.count(models.AccessLevel.id))
+            .filter(models.AccessLevel.name.in_(UF_CODES))
+            .scalar()
+        )
+        if present == len(UF_CODES):
+            return
+        existing_names = {
+            name
+            for (name,) in db.query(models.AccessLevel.name).filter(models.AccessLevel.name.in_(UF_CODES)).all()
+        }
+        missing = [uf for uf in UF_CODES if uf not in existing_names]
+        if missing:
+            db.add_all([models.AccessLevel(name=uf) for uf in missing])
+            db.commit()
+    finally:
+        db.close()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    ensure_state_access_levels()
+    start_heartbeat()
+    audit.start()
+    start_warmup()
+    reconciler.start()
+    yield
+    flush_hits()
+    processing.shutdown()
+    audit.stop()
+
+
+app = FastAPI(title="Portal Clientes", lifespan=lifespan, default_response_class=TimedJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -21,19 +64,11 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Added last so its timings include the CORS middleware
+app.add_middleware(ServerTimingMiddleware)
+
+app.include_router(health.router)
 app.include_router(auth.router)
 app.include_router(admin.router)
 app.include_router(spreadsheets.router)
 
-
-@app.on_event("startup")
-def ensure_state_access_levels():
-    db: Session = SessionLocal()
-    try:
-        existing_names = {name for (name,) in db.query(models.AccessLevel.name).all()}
-        missing = [uf for uf in UF_CODES if uf not in existing_names]
-        if missing:
-            db.add_all([models.AccessLevel(name=uf) for uf in missing])
-            db.commit()
-    finally:
-        db.close()
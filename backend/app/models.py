@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Enum, ForeignKey, Table, Boolean, DateTime
+from sqlalchemy import BigInteger, Column, Integer, String, Enum, ForeignKey, Table, Boolean, DateTime
 from sqlalchemy.orm import relationship
 from app.db import Base
 
@@ -58,7 +58,8 @@ class Spreadsheet(Base):
     __tablename__ = "spreadsheets"
     id = Column(Integer, primary_key=True, autoincrement=True)
     title = Column(String(150), nullable=False)
-    file_path = Column(String(255), nullable=False)
+    file_path = Column(String(255), nullable=False, index=True)
+    version = Column(Integer, nullable=False, default=1)
     uploaded_by = Column(Integer, ForeignKey("users.id"), nullable=False)
 
     access_levels = relationship(
@@ -66,3 +67,13 @@ class Spreadsheet(Base):
         secondary=spreadsheet_access,
         back_populates="spreadsheets",
     )
+
+class AuditEvent(Base):
+    __tablename__ = "access_audit"
+    # No foreign keys: the history must outlive deleted users and spreadsheets
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, nullable=False, index=True)
+    spreadsheet_id = Column(Integer, nullable=False, index=True)
+    action = Column(String(20), nullable=False)
+    detail = Column(String(255), nullable=True)
+    created_at = Column(DateTime, nullable=False, index=True)
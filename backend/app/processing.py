@@ -0,0 +1,136 @@
+import multiprocessing
+import threading
+import weakref
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fastapi import HTTPException, status
+from app.core.config import settings
+from app.datasets import add_hits, take_hits
+from app import timing
+
+# CPU-bound spreadsheet work runs in a process pool so it does not hold the GIL of the
+# worker that serves logins and listings. Children load spreadsheets through the same
+# memory-mapped Arrow files as the app workers and send back only the result page.
+
+_pool: ProcessPoolExecutor | None = None
+_lock = threading.Lock()
+_stats = {"submitted": 0, "completed": 0, "failed": 0, "timed_out": 0, "aborted": 0, "pending": 0}
+# Pools whose children were killed because of a timeout. The executor treats the death of
+# any child as a broken pool, so every other task it was running or queuing fails too;
+# those are counted as aborted rather than failed.
+_terminated: weakref.WeakSet = weakref.WeakSet()
+
+
+def enabled() -> bool:
+    return settings.process_pool_workers > 0
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=settings.process_pool_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                # Recycle children so memory from large sheets is returned to the OS
+                max_tasks_per_child=settings.process_pool_max_tasks_per_child,
+            )
+        return _pool
+
+
+def _discard_pool(pool: ProcessPoolExecutor, terminate: bool = False) -> None:
+    global _pool
+    with _lock:
+        if _pool is pool:
+            _pool = None
+    # A running task cannot be cancelled, killing its child is the only way to stop it.
+    # The executor has no public handle on its children before Python 3.14.
+    children = list((getattr(pool, "_processes", None) or {}).values()) if terminate else []
+    if terminate:
+        with _lock:
+            _terminated.add(pool)
+    pool.shutdown(wait=False, cancel_futures=True)
+    for child in children:
+        child.terminate()
+
+
+def _call_in_child(timed: bool, fn, *args):
+    # Sent back with the result, the request's timing lives in the parent. Children run
+    # no heartbeat, so their loads are flushed for warm-up by the parent's.
+    with timing.collect(timed) as child_timing:
+        result = fn(*args)
+    return result, child_timing, take_hits()
+
+
+def _task_done(future) -> None:
+    with _lock:
+        _stats["pending"] -= 1
+
+
+def _unavailable(pool: ProcessPoolExecutor) -> HTTPException:
+    _discard_pool(pool)
+    with _lock:
+        _stats["aborted" if pool in _terminated else "failed"] += 1
+    return HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Spreadsheet processing unavailable")
+
+
+def run(fn, *args):
+    """Runs ``fn(*args)`` in the pool, or inline when the pool is disabled."""
+    if not enabled():
+        return fn(*args)
+
+    pool = _get_pool()
+    with _lock:
+        _stats["submitted"] += 1
+        _stats["pending"] += 1
+    try:
+        future = pool.submit(_call_in_child, timing.recording(), fn, *args)
+    except RuntimeError:
+        # Broken, or shut down by another request since _get_pool()
+        _task_done(None)
+        raise _unavailable(pool)
+    # Pending until the task really ends, which for a timed out task is when its child is killed
+    future.add_done_callback(_task_done)
+    try:
+        # The whole round trip, the child's own stages are added once it returns
+        with timing.stage("pool"):
+            result, child_timing, hits = future.result(timeout=settings.process_pool_timeout_seconds)
+    except TimeoutError:
+        if not future.cancel():
+            # Already running; other tasks in this pool fail with 503, counted as aborted
+            _discard_pool(pool, terminate=True)
+        with _lock:
+            _stats["timed_out"] += 1
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail="Spreadsheet processing timed out")
+    except (BrokenProcessPool, CancelledError):
+        # Cancelled when the pool was discarded before the task started
+        raise _unavailable(pool)
+    except HTTPException:
+        raise
+    except Exception:
+        with _lock:
+            _stats["failed"] += 1
+        raise
+    with _lock:
+        _stats["completed"] += 1
+    timing.merge(child_timing)
+    add_hits(hits)
+    return result
+
+
+def metrics() -> dict:
+    with _lock:
+        return {
+            "enabled": enabled(),
+            "workers": settings.process_pool_workers,
+            "queue_depth": max(_stats["pending"] - settings.process_pool_workers, 0),
+            **_stats,
+        }
+
+
+def shutdown() -> None:
+    global _pool
+    with _lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,178 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from app import models
+from app.core.config import settings
+from app.datasets import SIDECAR_SUFFIXES, evict
+from app.db import SessionLocal
+from app.storage import PUBLISHING_DIR, TEMP_PREFIX, blob_lock, pending_publishes, reference_count
+
+logger = logging.getLogger(__name__)
+
+# Files are checked in batches with a short pause in between, so a pass over a large
+# upload directory never competes with requests for long.
+_BATCH_SIZE = 500
+_BATCH_PAUSE_SECONDS = 0.05
+# CSV conversions written next to the uploads by older versions of the download endpoint
+_LEGACY_TEMP_SUFFIX = "_temp.csv"
+
+
+def _stats_path() -> str:
+    return os.path.join(settings.parsed_dir, "storage.json")
+
+
+def _referenced_names() -> set[str]:
+    db = SessionLocal()
+    try:
+        return {os.path.basename(p) for (p,) in db.query(models.Spreadsheet.file_path).all() if p}
+    finally:
+        db.close()
+
+
+def _sidecar_owner(name: str) -> str | None:
+    # Longest first, ".search.arrow" also ends with ".arrow"
+    for suffix in sorted(SIDECAR_SUFFIXES, key=len, reverse=True):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return None
+
+
+def _is_orphan(directory: str, entry: os.DirEntry, referenced: set[str]) -> bool:
+    name = entry.name
+    if os.path.basename(directory) == PUBLISHING_DIR:
+        return True
+    if directory == settings.upload_dir:
+        if name.startswith(TEMP_PREFIX) or name.endswith(_LEGACY_TEMP_SUFFIX):
+            return True
+        # Other dot files (the audit spill, the parsed cache) are not uploads
+        return not name.startswith(".") and name not in referenced
+    if name.endswith(".tmp"):
+        return True
+    owner = _sidecar_owner(name)
+    return owner is not None and not os.path.exists(os.path.join(settings.upload_dir, owner))
+
+
+def _remove_orphan(directory: str, entry: os.DirEntry, grace_before: float) -> bool:
+    path = entry.path
+    if directory != settings.upload_dir or entry.name.startswith(TEMP_PREFIX):
+        try:
+            os.remove(path)
+        except OSError:
+            return False
+        return True
+    with blob_lock():
+        try:
+            # Checked again right before removal, a deduplicated upload refreshes the mtime
+            if os.stat(path).st_mtime > grace_before:
+                return False
+            if pending_publishes(path):
+                return False
+            db = SessionLocal()
+            try:
+                if reference_count(db, path):
+                    return False
+            finally:
+                db.close()
+            evict(path)
+            os.remove(path)
+        except OSError:
+            return False
+    return True
+
+
+def _scan(directory: str, kind: str, referenced: set[str], grace_before: float, totals: dict) -> None:
+    try:
+        entries = os.scandir(directory)
+    except FileNotFoundError:
+        return
+    with entries:
+        for count, entry in enumerate(entries, start=1):
+            if count % _BATCH_SIZE == 0:
+                time.sleep(_BATCH_PAUSE_SECONDS)
+            try:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            totals["files"] += 1
+            if not _is_orphan(directory, entry, referenced):
+                totals[f"{kind}_bytes"] += stat.st_size
+            elif stat.st_mtime <= grace_before and _remove_orphan(directory, entry, grace_before):
+                totals["removed_files"] += 1
+                totals["removed_bytes"] += stat.st_size
+            else:
+                totals["pending_orphan_files"] += 1
+                totals["pending_orphan_bytes"] += stat.st_size
+
+
+def reconcile() -> dict:
+    """Removes upload and parsed files no spreadsheet uses once they are older than the grace period."""
+    started = time.time()
+    grace_before = started - settings.storage_orphan_grace_seconds
+    referenced = _referenced_names()
+    totals = {
+        "files": 0,
+        "upload_bytes": 0,
+        "parsed_bytes": 0,
+        "removed_files": 0,
+        "removed_bytes": 0,
+        "pending_orphan_files": 0,
+        "pending_orphan_bytes": 0,
+    }
+    _scan(settings.upload_dir, "upload", referenced, grace_before, totals)
+    _scan(settings.parsed_dir, "parsed", referenced, grace_before, totals)
+    # Markers left by uploads whose worker died before committing
+    _scan(os.path.join(settings.upload_dir, PUBLISHING_DIR), "upload", referenced, grace_before, totals)
+    totals["started_at"] = started
+    totals["duration_seconds"] = round(time.time() - started, 3)
+    return totals
+
+
+def _save_stats(stats: dict) -> None:
+    temp_path = f"{_stats_path()}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(stats, f)
+    os.replace(temp_path, _stats_path())
+
+
+def read_stats() -> dict | None:
+    """Returns the result of the last pass run by any worker."""
+    try:
+        with open(_stats_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def run_once() -> dict | None:
+    os.makedirs(settings.parsed_dir, exist_ok=True)
+    with open(os.path.join(settings.parsed_dir, "storage.lock"), "a") as lock:
+        try:
+            # Only one worker reconciles at a time, the others skip this round
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        stats = reconcile()
+        _save_stats(stats)
+    if stats["removed_files"]:
+        logger.info("Removed %d orphaned files (%d bytes)", stats["removed_files"], stats["removed_bytes"])
+    return stats
+
+
+def _loop() -> None:
+    while True:
+        time.sleep(settings.storage_reconcile_seconds)
+        try:
+            run_once()
+        except Exception:
+            logger.exception("Storage reconciliation failed")
+
+
+def start() -> None:
+    if settings.storage_reconcile_seconds <= 0:
+        return
+    threading.Thread(target=_loop, name="storage-reconciler", daemon=True).start()
@@ -1,16 +1,23 @@
-from fastapi import APIRouter, Depends, UploadFile, File, Form, HTTPException
+from fastapi import APIRouter, BackgroundTasks, Depends, UploadFile, File, Form, HTTPException, Query
+from sqlalchemy import delete, exists, insert, literal, or_, select
 from sqlalchemy.orm import Session
-from app import models, schemas
+from app import audit, column_stats, models, processing, reconciler, schemas, search_text
 from app.dependencies import get_db, get_current_admin
 from app.auth import hash_password
 from app.constants import UF_CODE_SET
+from app.datasets import ARROW_SUFFIX, SIDECAR_SUFFIXES, append_rows, cache_frame, frame_memory, load_dataframe, read_columns, read_dataframe, sidecar_path
+from app.workers import read_worker_stats
+from app.storage import discard, new_temp_path, publish_done, release, release_later, store_file, store_stream
+import logging
 import secrets
-from app.core.config import settings
 import os
-import uuid
+
+SPREADSHEET_EXTENSIONS = [".xlsx", ".xls", ".csv"]
 
 router = APIRouter(prefix="/admin", tags=["admin"])
 
+logger = logging.getLogger(__name__)
+
 
 def _normalize_uf(uf: str | None) -> str | None:
     if uf is None:
@@ -23,13 +30,103 @@ def _sync_user_uf_access_levels(db: Session, user: models.User, selected_access_
     if not user.uf:
         return
     selected_ids = set(selected_access_level_ids or [])
-    levels = db.query(models.AccessLevel).all()
-    uf_level_ids = {level.id for level in levels if level.name in UF_CODE_SET}
-    user_uf_level = next((level for level in levels if level.name == user.uf), None)
-    selected_ids -= uf_level_ids
-    if user_uf_level:
-        selected_ids.add(user_uf_level.id)
-    user.access_levels = [level for level in levels if level.id in selected_ids]
+    # Only the selected levels and the user's UF level are loaded
+    levels = (
+        db.query(models.AccessLevel)
+        .filter(or_(models.AccessLevel.id.in_(selected_ids), models.AccessLevel.name == user.uf))
+        .all()
+    )
+    user.access_levels = [level for level in levels if level.name == user.uf or level.name not in UF_CODE_SET]
+
+
+def _get_bulk_access_level(db: Session, access_level_id: int) -> models.AccessLevel:
+    level = db.query(models.AccessLevel).filter(models.AccessLevel.id == access_level_id).first()
+    if not level:
+        raise HTTPException(status_code=404, detail="Access level not found")
+    if level.name in UF_CODE_SET:
+        # UF levels always follow the user's UF, see _sync_user_uf_access_levels
+        raise HTTPException(status_code=400, detail="UF access levels cannot be assigned in bulk")
+    return level
+
+
+def _bulk_user_ids(payload: schemas.AccessLevelBulkFilter):
+    """SELECT of the ids of the users matching every given filter."""
+    uf = _normalize_uf(payload.uf)
+    if uf is None and payload.access_level_id is None and not payload.cnpjs:
+        raise HTTPException(status_code=400, detail="At least one filter is required")
+    if uf is not None and uf not in UF_CODE_SET:
+        raise HTTPException(status_code=400, detail="UF invalid")
+    query = select(models.User.id)
+    if uf is not None:
+        query = query.where(models.User.uf == uf)
+    if payload.cnpjs:
+        query = query.where(models.User.cnpj.in_(payload.cnpjs))
+    if payload.access_level_id is not None:
+        links = models.user_access_levels.c
+        query = query.where(
+            exists().where(links.user_id == models.User.id, links.access_level_id == payload.access_level_id)
+        )
+    return query
+
+
+def _upload_extension(file: UploadFile) -> str:
+    ext = os.path.splitext(file.filename)[1].lower()
+    if ext not in SPREADSHEET_EXTENSIONS:
+        raise HTTPException(status_code=400, detail="Unsupported file")
+    return ext
+
+
+def _load_upload_or_400(db: Session, file_path: str):
+    try:
+        return load_dataframe(file_path)
+    except Exception:
+        discard(db, file_path)
+        raise HTTPException(status_code=400, detail="Could not read spreadsheet")
+
+
+def _read_rows_or_400(file: UploadFile, ext: str):
+    rows_path = new_temp_path(ext)
+    try:
+        with open(rows_path, "wb") as f:
+            while block := file.file.read(1024 * 1024):
+                f.write(block)
+        return read_dataframe(rows_path)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Could not read spreadsheet")
+    finally:
+        os.remove(rows_path)
+
+
+def _precompute_derived(file_path: str) -> None:
+    # Runs after the response, so ingest cost is not paid by the admin's request
+    try:
+        column_stats.ensure(file_path)
+        search_text.load(file_path)
+    except Exception:
+        logger.exception("Could not precompute derived data for %s", file_path)
+
+
+def _precompute_appended(old_path: str, new_path: str) -> None:
+    # Derived data of the previous version is extended with the appended rows only
+    try:
+        column_stats.extend(old_path, new_path)
+        search_text.extend(old_path, new_path)
+    except Exception:
+        logger.exception("Could not extend derived data for %s", new_path)
+        _precompute_derived(new_path)
+
+
+def _get_spreadsheet_for_update(db: Session, spreadsheet_id: int) -> models.Spreadsheet:
+    # Row lock serializes concurrent replace/append calls on the same spreadsheet
+    s = (
+        db.query(models.Spreadsheet)
+        .filter(models.Spreadsheet.id == spreadsheet_id)
+        .with_for_update()
+        .first()
+    )
+    if not s:
+        raise HTTPException(status_code=404, detail="Spreadsheet not found")
+    return s
 
 
 @router.get("/access-levels", response_model=list[schemas.AccessLevelItem])
@@ -91,6 +188,47 @@ def update_user_access_levels(
     db.commit()
     return {"status": "ok"}
 
+@router.post("/access-levels/{access_level_id}/grant")
+def grant_access_level(
+    access_level_id: int,
+    payload: schemas.AccessLevelBulkFilter,
+    db: Session = Depends(get_db),
+    admin=Depends(get_current_admin),
+):
+    level = _get_bulk_access_level(db, access_level_id)
+    links = models.user_access_levels.c
+    users = _bulk_user_ids(payload).where(
+        ~exists().where(links.user_id == models.User.id, links.access_level_id == level.id)
+    )
+    statement = (
+        insert(models.user_access_levels)
+        .from_select(["user_id", "access_level_id"], users.add_columns(literal(level.id)))
+        # Rows granted concurrently by another request are skipped instead of failing
+        .prefix_with("IGNORE", dialect="mysql")
+    )
+    result = db.execute(statement)
+    db.commit()
+    return {"status": "ok", "affected": result.rowcount}
+
+@router.post("/access-levels/{access_level_id}/revoke")
+def revoke_access_level(
+    access_level_id: int,
+    payload: schemas.AccessLevelBulkFilter,
+    db: Session = Depends(get_db),
+    admin=Depends(get_current_admin),
+):
+    level = _get_bulk_access_level(db, access_level_id)
+    # MySQL rejects reading user_access_levels in the filter of a DELETE from it (error 1093)
+    # unless the read goes through a derived table; DISTINCT keeps it from being merged back
+    users = _bulk_user_ids(payload).distinct().subquery()
+    statement = delete(models.user_access_levels).where(
+        models.user_access_levels.c.access_level_id == level.id,
+        models.user_access_levels.c.user_id.in_(select(users.c.id)),
+    )
+    result = db.execute(statement)
+    db.commit()
+    return {"status": "ok", "affected": result.rowcount}
+
 @router.delete("/users/{user_id}")
 def delete_user(user_id: int, db: Session = Depends(get_db), admin=Depends(get_current_admin)):
     user = db.query(models.User).filter(models.User.id == user_id).first()
@@ -114,39 +252,142 @@ def list_spreadsheets_admin(db: Session = Depends(get_db), admin=Depends(get_cur
         for s in items
     ]
 
+def _file_size(path: str) -> int | None:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+@router.get("/spreadsheets/memory")
+def spreadsheet_memory(
+    load: bool = Query(False, description="Load spreadsheets not yet parsed in this worker"),
+    db: Session = Depends(get_db),
+    admin=Depends(get_current_admin),
+):
+    items = []
+    frame_bytes = {}
+    for s in db.query(models.Spreadsheet).order_by(models.Spreadsheet.id).all():
+        if load and os.path.exists(s.file_path):
+            load_dataframe(s.file_path)
+        frame_bytes[s.file_path] = frame_memory(s.file_path)
+        items.append({
+            "id": s.id,
+            "title": s.title,
+            "file_bytes": _file_size(s.file_path),
+            "arrow_bytes": _file_size(sidecar_path(s.file_path, ARROW_SUFFIX)),
+            # None when the spreadsheet is not loaded in the worker answering this request
+            "frame_bytes": frame_bytes[s.file_path],
+        })
+    return {
+        "pid": os.getpid(),
+        "spreadsheets": items,
+        # Spreadsheets with identical content share one frame
+        "total_frame_bytes": sum(size or 0 for size in frame_bytes.values()),
+    }
+
 @router.post("/spreadsheets")
 def upload_spreadsheet(
+    background_tasks: BackgroundTasks,
     title: str = Form(...),
     access_level_ids: str = Form(""),
     file: UploadFile = File(...),
     db: Session = Depends(get_db),
     admin=Depends(get_current_admin),
 ):
-    os.makedirs(settings.upload_dir, exist_ok=True)
-    ext = os.path.splitext(file.filename)[1].lower()
-    if ext not in [".xlsx", ".xls", ".csv"]:
-        raise HTTPException(status_code=400, detail="Unsupported file")
+    ext = _upload_extension(file)
+    file_path = store_stream(file.file, ext)
 
-    filename = f"{uuid.uuid4().hex}{ext}"
-    file_path = os.path.join(settings.upload_dir, filename)
-    with open(file_path, "wb") as f:
-        f.write(file.file.read())
-
-    spreadsheet = models.Spreadsheet(title=title, file_path=file_path, uploaded_by=admin.id)
-    access_ids = []
-    if access_level_ids:
-        try:
-            access_ids = [int(x) for x in access_level_ids.split(",") if x.strip()]
-        except ValueError:
-            raise HTTPException(status_code=400, detail="access_level_ids must be comma-separated integers")
-
-    access_levels = db.query(models.AccessLevel).filter(models.AccessLevel.id.in_(access_ids)).all() if access_ids else []
-    spreadsheet.access_levels = access_levels
-    db.add(spreadsheet)
-    db.commit()
+    try:
+        spreadsheet = models.Spreadsheet(title=title, file_path=file_path, uploaded_by=admin.id)
+        access_ids = []
+        if access_level_ids:
+            try:
+                access_ids = [int(x) for x in access_level_ids.split(",") if x.strip()]
+            except ValueError:
+                raise HTTPException(status_code=400, detail="access_level_ids must be comma-separated integers")
+
+        access_levels = db.query(models.AccessLevel).filter(models.AccessLevel.id.in_(access_ids)).all() if access_ids else []
+        spreadsheet.access_levels = access_levels
+        db.add(spreadsheet)
+        db.commit()
+    finally:
+        publish_done(file_path)
     db.refresh(spreadsheet)
+    background_tasks.add_task(_precompute_derived, file_path)
     return {"id": spreadsheet.id}
 
+@router.put("/spreadsheets/{spreadsheet_id}/file")
+def replace_spreadsheet_file(
+    spreadsheet_id: int,
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    db: Session = Depends(get_db),
+    admin=Depends(get_current_admin),
+):
+    ext = _upload_extension(file)
+    s = _get_spreadsheet_for_update(db, spreadsheet_id)
+    file_path = store_stream(file.file, ext)
+    try:
+        _load_upload_or_400(db, file_path)
+
+        # Readers resolve file_path once per request, so they see either the old or the new file
+        old_path = s.file_path
+        s.file_path = file_path
+        s.version = (s.version or 1) + 1
+        db.commit()
+    finally:
+        publish_done(file_path)
+    if old_path and old_path != file_path:
+        release_later(old_path)
+    background_tasks.add_task(_precompute_derived, file_path)
+    return {"id": s.id, "version": s.version}
+
+@router.post("/spreadsheets/{spreadsheet_id}/rows")
+def append_spreadsheet_rows(
+    spreadsheet_id: int,
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    db: Session = Depends(get_db),
+    admin=Depends(get_current_admin),
+):
+    ext = _upload_extension(file)
+    s = _get_spreadsheet_for_update(db, spreadsheet_id)
+    if not os.path.exists(s.file_path):
+        raise HTTPException(status_code=404, detail="File missing")
+
+    rows = _read_rows_or_400(file, ext)
+
+    current_columns = read_columns(s.file_path)
+    unknown = [c for c in rows.columns if c not in current_columns]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown columns: {', '.join(map(str, unknown))}")
+
+    old_path = s.file_path
+    old_ext = os.path.splitext(old_path)[1].lower()
+    # Legacy .xls files cannot be written back, new versions are stored as .xlsx
+    new_ext = ".xlsx" if old_ext == ".xls" else old_ext
+    temp_path = new_temp_path(new_ext)
+    try:
+        combined = append_rows(old_path, rows, temp_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    new_path = store_file(temp_path, new_ext)
+    try:
+        if combined is not None:
+            cache_frame(new_path, combined)
+
+        s.file_path = new_path
+        s.version = (s.version or 1) + 1
+        db.commit()
+    finally:
+        publish_done(new_path)
+    if old_path != new_path:
+        release_later(old_path)
+        background_tasks.add_task(_precompute_appended, old_path, new_path)
+    return {"id": s.id, "version": s.version, "appended": len(rows)}
+
 @router.delete("/spreadsheets/{spreadsheet_id}")
 def delete_spreadsheet(spreadsheet_id: int, db: Session = Depends(get_db), admin=Depends(get_current_admin)):
     s = db.query(models.Spreadsheet).filter(models.Spreadsheet.id == spreadsheet_id).first()
@@ -155,9 +396,86 @@ def delete_spreadsheet(spreadsheet_id: int, db: Session = Depends(get_db), admin
     file_path = s.file_path
     db.delete(s)
     db.commit()
-    if file_path and os.path.exists(file_path):
-        try:
-            os.remove(file_path)
-        except OSError:
-            pass
+    # Other spreadsheets uploaded with identical content keep the blob alive
+    release(db, file_path)
     return {"status": "deleted"}
+
+@router.get("/workers")
+def list_workers(admin=Depends(get_current_admin)):
+    workers = read_worker_stats()
+    return {
+        "workers": workers,
+        "total_rss_bytes": sum(w["rss_bytes"] for w in workers),
+    }
+
+@router.get("/process-pool")
+def process_pool_metrics(admin=Depends(get_current_admin)):
+    return processing.metrics()
+
+@router.get("/storage")
+def storage_usage(db: Session = Depends(get_db), admin=Depends(get_current_admin)):
+    items = []
+    for s in db.query(models.Spreadsheet).order_by(models.Spreadsheet.id).all():
+        derived = [_file_size(sidecar_path(s.file_path, suffix)) for suffix in SIDECAR_SUFFIXES]
+        items.append({
+            "id": s.id,
+            "title": s.title,
+            "file_bytes": _file_size(s.file_path),
+            "derived_bytes": sum(size or 0 for size in derived),
+        })
+    return {
+        "spreadsheets": items,
+        # Directory totals from the last reconciliation pass of any worker
+        "totals": reconciler.read_stats(),
+    }
+
+@router.post("/storage/reconcile")
+def reconcile_storage(admin=Depends(get_current_admin)):
+    stats = reconciler.run_once()
+    if stats is None:
+        raise HTTPException(status_code=409, detail="Reconciliation already running")
+    return stats
+
+@router.get("/audit", response_model=schemas.AuditPage)
+def list_audit_events(
+    offset: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=500),
+    user_id: int | None = None,
+    spreadsheet_id: int | None = None,
+    action: str | None = None,
+    db: Session = Depends(get_db),
+    admin=Depends(get_current_admin),
+):
+    query = (
+        db.query(models.AuditEvent, models.User.cnpj, models.Spreadsheet.title)
+        .outerjoin(models.User, models.User.id == models.AuditEvent.user_id)
+        .outerjoin(models.Spreadsheet, models.Spreadsheet.id == models.AuditEvent.spreadsheet_id)
+    )
+    if user_id is not None:
+        query = query.filter(models.AuditEvent.user_id == user_id)
+    if spreadsheet_id is not None:
+        query = query.filter(models.AuditEvent.spreadsheet_id == spreadsheet_id)
+    if action:
+        query = query.filter(models.AuditEvent.action == action)
+    rows = query.order_by(models.AuditEvent.id.desc()).offset(offset).limit(limit).all()
+    return {
+        "offset": offset,
+        "limit": limit,
+        "items": [
+            {
+                "id": e.id,
+                "user_id": e.user_id,
+                "user_cnpj": cnpj,
+                "spreadsheet_id": e.spreadsheet_id,
+                "spreadsheet_title": title,
+                "action": e.action,
+                "detail": e.detail,
+                "created_at": e.created_at,
+            }
+            for e, cnpj, title in rows
+        ],
+    }
+
+@router.get("/audit/stats")
+def audit_stats(admin=Depends(get_current_admin)):
+    return dict(audit.stats)
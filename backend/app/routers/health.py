@@ -0,0 +1,18 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from app import warmup
+
+router = APIRouter(prefix="/health", tags=["health"])
+
+
+@router.get("")
+def health():
+    return {"status": "ok"}
+
+
+@router.get("/ready")
+def readiness():
+    body = dict(warmup.state)
+    if not warmup.is_ready():
+        return JSONResponse(status_code=503, content=body)
+    return body
@@ -1,27 +1,41 @@
+from concurrent.futures import ThreadPoolExecutor, wait
 from fastapi import APIRouter, Depends, HTTPException, Query
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from sqlalchemy.orm import Session, joinedload
-from app import models
+from app import audit, column_stats, models, processing, search_text
+from app.admission import controller as admission, estimate_cost
+from app.core.config import settings
+from app.datasets import CHUNK_ROWS, SEARCH_SUFFIX, iter_dataframe_chunks, load_dataframe, memoize, read_columns, sidecar_path
 from app.dependencies import get_db, get_current_user
-import pandas as pd
-import numpy as np
+from app.search_text import normalize_text as _normalize_text
+from app.timing import count, stage
+from typing import TYPE_CHECKING
+from urllib.parse import quote
+import math
+import numbers
 import os
+import logging
 import re
-import unicodedata
+import tempfile
+import time
+
+# pandas/numpy are imported inside the handlers that need them to keep startup fast
+if TYPE_CHECKING:
+    import pandas as pd
 
 router = APIRouter(prefix="/spreadsheets", tags=["spreadsheets"])
 
+logger = logging.getLogger(__name__)
+
+# Searches across all spreadsheets scan Arrow-backed shadow text, which releases the GIL
+_search_executor = ThreadPoolExecutor(max_workers=settings.search_all_threads, thread_name_prefix="search-all")
+
 
 def _has_required_access(spreadsheet: models.Spreadsheet, user_access_ids: set[int]) -> bool:
     required_ids = {level.id for level in spreadsheet.access_levels}
     return required_ids.issubset(user_access_ids)
 
 
-def _normalize_text(text: str) -> str:
-    base = unicodedata.normalize("NFKD", str(text))
-    return "".join(ch for ch in base if not unicodedata.combining(ch)).lower()
-
-
 def _is_currency_column(column_name: str) -> bool:
     normalized = _normalize_text(column_name)
     return "preco" in normalized or "valor" in normalized
@@ -30,10 +44,12 @@ def _is_currency_column(column_name: str) -> bool:
 def _to_float(value):
     if value is None:
         return None
-    if isinstance(value, (int, float, np.integer, np.floating)):
-        if pd.isna(value) or np.isinf(value):
+    # numbers.Real also covers numpy integer and floating scalars
+    if isinstance(value, numbers.Real):
+        number = float(value)
+        if math.isnan(number) or math.isinf(number):
             return None
-        return float(value)
+        return number
 
     text = str(value).strip()
     if not text:
@@ -66,19 +82,332 @@ def _format_brl(value):
     formatted = f"{number:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
     return f"R$ {formatted}"
 
-@router.get("")
-def list_spreadsheets(db: Session = Depends(get_db), user=Depends(get_current_user)):
+
+def _accessible_spreadsheets(db: Session, user) -> list[models.Spreadsheet]:
     if user.is_admin:
-        items = db.query(models.Spreadsheet).all()
+        return db.query(models.Spreadsheet).all()
+    user_access_ids = {level.id for level in user.access_levels}
+    items = (
+        db.query(models.Spreadsheet)
+        .options(joinedload(models.Spreadsheet.access_levels))
+        .all()
+    )
+    return [item for item in items if _has_required_access(item, user_access_ids)]
+
+
+def _get_accessible_spreadsheet(db: Session, spreadsheet_id: int, user) -> models.Spreadsheet:
+    with stage("access"):
+        s = db.query(models.Spreadsheet).filter(models.Spreadsheet.id == spreadsheet_id).first()
+        if not s:
+            raise HTTPException(status_code=404, detail="Not found")
+
+        if not user.is_admin:
+            user_access_ids = {level.id for level in user.access_levels}
+            if not _has_required_access(s, user_access_ids):
+                raise HTTPException(status_code=403, detail="Forbidden")
+
+        if not os.path.exists(s.file_path):
+            raise HTTPException(status_code=404, detail="File missing")
+        return s
+
+
+def _search_mask(df: "pd.DataFrame", search: str, col: str | None, checkpoint=None, shadow=None) -> "pd.Series":
+    """Accent-insensitive match of every search term, against ``col`` or any column."""
+    terms = search_text.split_terms(search)
+    column = col if col and col in df.columns else None
+    if shadow is None:
+        # Chunks streamed from the file have no precomputed shadow text
+        shadow = search_text.build(df[[column]] if column is not None else df)
+    return search_text.matches(shadow, terms, column, checkpoint=checkpoint)
+
+
+def _iter_filtered_chunks(file_path: str, search: str | None, col: str | None):
+    if search and os.path.exists(sidecar_path(file_path, SEARCH_SUFFIX)):
+        # The shadow text is row-aligned with the parsed frame, not with chunks streamed
+        # from the file (openpyxl skips blank rows that pandas keeps), so both are sliced
+        df = load_dataframe(file_path)
+        shadow = search_text.load(file_path)
+        for start in range(0, max(len(df), 1), CHUNK_ROWS):
+            chunk = df.iloc[start:start + CHUNK_ROWS]
+            yield chunk[_search_mask(chunk, search, col, shadow=shadow.iloc[start:start + CHUNK_ROWS])]
+        return
+    for chunk in iter_dataframe_chunks(file_path):
+        if search:
+            chunk = chunk[_search_mask(chunk, search, col)]
+        yield chunk
+
+
+def _release_when_done(blocks, admitted):
+    try:
+        yield from blocks
+    finally:
+        admitted.__exit__(None, None, None)
+
+
+def _attachment_headers(filename: str) -> dict:
+    return {"Content-Disposition": f"attachment; filename*=utf-8''{quote(filename)}"}
+
+
+def _stream_csv(chunks):
+    header = True
+    for chunk in chunks:
+        yield chunk.to_csv(index=False, header=header)
+        header = False
+
+
+def _stream_ndjson(chunks):
+    for chunk in chunks:
+        if chunk.empty:
+            continue
+        text = chunk.to_json(orient="records", lines=True, force_ascii=False, date_format="iso")
+        yield text if text.endswith("\n") else text + "\n"
+
+
+def _stream_xlsx(chunks, block_size: int = 64 * 1024):
+    from openpyxl import Workbook
+
+    # write_only workbooks flush rows to disk as they are appended
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    header_written = False
+    for chunk in chunks:
+        if not header_written:
+            ws.append([str(c) for c in chunk.columns])
+            header_written = True
+        chunk = chunk.astype(object).where(chunk.notna(), None)
+        for row in chunk.itertuples(index=False, name=None):
+            ws.append(list(row))
+
+    fd, temp_path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    try:
+        wb.save(temp_path)
+        with open(temp_path, "rb") as f:
+            while block := f.read(block_size):
+                yield block
+    finally:
+        os.remove(temp_path)
+
+
+def _build_data_page(
+    file_path: str,
+    offset: int,
+    limit: int,
+    search: str | None,
+    col: str | None,
+    checkpoint=None,
+    match: str = "contains",
+) -> dict:
+    df = load_dataframe(file_path)
+
+    if search and match != "contains":
+        with stage("search"):
+            positions = search_text.lookup(file_path, col, search, match)
+        count("rows_scanned", len(positions))
+        df = df.iloc[positions]
+    elif search:
+        count("rows_scanned", len(df))
+        with stage("search"):
+            df = df[_search_mask(df, search, col, checkpoint=checkpoint, shadow=search_text.load(file_path))]
     else:
-        user_access_ids = {level.id for level in user.access_levels}
-        items = (
-            db.query(models.Spreadsheet)
-            .options(joinedload(models.Spreadsheet.access_levels))
-            .all()
-        )
-        items = [item for item in items if _has_required_access(item, user_access_ids)]
-    return [{"id": s.id, "title": s.title} for s in items]
+        count("rows_scanned", len(df))
+    if checkpoint:
+        checkpoint()
+
+    page = df.iloc[offset:offset + limit]
+    count("rows_returned", len(page))
+    return _format_page(page)
+
+
+def _format_page(df: "pd.DataFrame") -> dict:
+    with stage("format"):
+        # copy so formatting never touches the cached frame
+        df = df.copy()
+        for column in df.columns:
+            if _is_currency_column(column):
+                df[column] = df[column].apply(_format_brl)
+        # sanitize to JSON-safe values; cached frames are Arrow-backed and use pd.NA for missing cells
+        df = df.astype(object).replace({math.inf: None, -math.inf: None})
+        df = df.where(df.notna(), None)
+        return {
+            "columns": list(df.columns),
+            "rows": df.to_dict(orient="records"),
+        }
+
+
+class _SearchExpired(Exception):
+    pass
+
+
+def _search_sheet(file_path: str, terms: list[str], limit: int, deadline: float) -> dict:
+    def checkpoint():
+        if time.monotonic() > deadline:
+            raise _SearchExpired()
+
+    checkpoint()
+    shadow = search_text.load(file_path)
+    mask = search_text.matches(shadow, terms, checkpoint=checkpoint)
+    total = int(mask.sum())
+    if not total:
+        return {"total": 0}
+    page = _format_page(load_dataframe(file_path)[mask.to_numpy()].iloc[:limit])
+    return {"total": total, **page}
+
+
+_METRIC_PATTERN = re.compile(r"\s*(sum|avg|min|max|count)\s*(?:\(([^)]*)\))?\s*(?:,|$)", re.IGNORECASE)
+
+
+def _resolve_column(columns, name: str) -> str:
+    if name in columns:
+        return name
+    # Lets "avg(Preco)" match a "Preço" column
+    normalized = _normalize_text(name.strip())
+    for column in columns:
+        if _normalize_text(column) == normalized:
+            return column
+    raise HTTPException(status_code=400, detail=f"Unknown column: {name}")
+
+
+def _parse_metrics(metrics: str, columns) -> list[tuple[str, str | None]]:
+    parsed = []
+    text = metrics.strip()
+    pos = 0
+    while pos < len(text):
+        match = _METRIC_PATTERN.match(text, pos)
+        if not match or match.end() == pos:
+            raise HTTPException(status_code=400, detail="Invalid metrics")
+        func, column = match.group(1).lower(), match.group(2)
+        if column is not None and column.strip():
+            column = _resolve_column(columns, column)
+        elif func != "count":
+            raise HTTPException(status_code=400, detail=f"{func} requires a column")
+        else:
+            column = None
+        parsed.append((func, column))
+        pos = match.end()
+    if not parsed:
+        raise HTTPException(status_code=400, detail="Invalid metrics")
+    return parsed
+
+
+def _to_float_series(series: "pd.Series") -> "pd.Series":
+    """Vectorized _to_float: numeric columns are cast, text is parsed once per distinct value."""
+    import numpy as np
+    import pandas as pd
+
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        values = series.to_numpy(dtype="float64", na_value=np.nan)
+        # May be a read-only view of the memory-mapped Arrow buffer
+        values = np.where(np.isinf(values), np.nan, values)
+    else:
+        codes, uniques = pd.factorize(series)
+        parsed = [_to_float(value) for value in uniques]
+        # Trailing NaN is what code -1 (missing value) picks up
+        lookup = np.array([np.nan if v is None else v for v in parsed] + [np.nan], dtype="float64")
+        values = lookup[codes]
+    return pd.Series(values, index=series.index)
+
+
+def _metric_label(func: str, column: str | None) -> str:
+    return f"{func}({column})" if column is not None else func
+
+
+def _aggregate(file_path: str, group_by: list[str], metrics: list[tuple[str, str | None]]) -> dict:
+    import pandas as pd
+
+    df = load_dataframe(file_path)
+    data = pd.DataFrame(index=df.index)
+    numeric = {}
+    for func, column in metrics:
+        label = _metric_label(func, column)
+        if func == "count":
+            data[label] = 1 if column is None else df[column].notna().astype("int64")
+        else:
+            if column not in numeric:
+                numeric[column] = _to_float_series(df[column])
+            data[label] = numeric[column]
+
+    if group_by:
+        # observed=True keeps categorical keys from expanding into every combination of categories
+        grouped = data.groupby([df[column] for column in group_by], dropna=False, sort=True, observed=True)
+    else:
+        grouped = data.groupby(lambda _: 0)
+
+    results = {}
+    for func, column in metrics:
+        label = _metric_label(func, column)
+        series = grouped[label]
+        if func in ("count", "sum"):
+            results[label] = series.sum() if func == "count" else series.sum(min_count=1)
+        elif func == "avg":
+            results[label] = series.mean()
+        elif func == "min":
+            results[label] = series.min()
+        else:
+            results[label] = series.max()
+    result = pd.DataFrame(results)
+    result = result.reset_index() if group_by else result.reset_index(drop=True)
+
+    for func, column in metrics:
+        if func != "count" and _is_currency_column(column):
+            label = _metric_label(func, column)
+            result[label] = result[label].apply(_format_brl)
+    result = result.astype(object)
+    result = result.where(result.notna(), None)
+    return {
+        "columns": [str(c) for c in result.columns],
+        "rows": result.to_dict(orient="records"),
+    }
+
+@router.get("")
+def list_spreadsheets(db: Session = Depends(get_db), user=Depends(get_current_user)):
+    return [{"id": s.id, "title": s.title} for s in _accessible_spreadsheets(db, user)]
+
+@router.get("/search")
+def search_spreadsheets(
+    q: str = Query(..., min_length=1),
+    limit: int = Query(5, ge=1, le=50),
+    db: Session = Depends(get_db),
+    user=Depends(get_current_user),
+):
+    terms = search_text.split_terms(q)
+    if not terms:
+        raise HTTPException(status_code=400, detail="Empty search")
+    sheets = [s for s in _accessible_spreadsheets(db, user) if os.path.exists(s.file_path)]
+    cost = sum(estimate_cost(s.file_path, q) for s in sheets)
+    deadline = time.monotonic() + settings.search_all_budget_seconds
+
+    with admission.admit(user.id, cost, supersede_key=(user.id, "search")) as ticket:
+        futures = {
+            _search_executor.submit(_search_sheet, s.file_path, terms, limit, deadline): s
+            for s in sheets
+        }
+        wait(futures, timeout=max(deadline - time.monotonic(), 0))
+        admission.checkpoint(ticket)
+
+    results = []
+    timed_out = []
+    for future, s in futures.items():
+        error = future.exception() if future.done() else None
+        if not future.done() or isinstance(error, _SearchExpired):
+            # Unfinished sheets stop at their next checkpoint
+            timed_out.append(s.id)
+            continue
+        if error is not None:
+            # One unreadable sheet does not fail the search of the others
+            logger.warning("Search of spreadsheet %s failed: %s", s.id, error)
+            continue
+        hits = future.result()
+        if hits["total"]:
+            audit.record(user.id, s.id, "search", q)
+            results.append({"id": s.id, "title": s.title, **hits})
+    results.sort(key=lambda r: r["total"], reverse=True)
+    return {
+        "query": q,
+        "searched": len(sheets) - len(timed_out),
+        "timed_out": sorted(timed_out),
+        "results": results,
+    }
 
 @router.get("/{spreadsheet_id}/data")
 def get_spreadsheet_data(
@@ -87,45 +416,79 @@ def get_spreadsheet_data(
     limit: int = Query(100, ge=1, le=500),
     search: str | None = None,
     col: str | None = None,
+    match: str = Query("contains", pattern="^(contains|exact|prefix)$"),
     db: Session = Depends(get_db),
     user=Depends(get_current_user),
 ):
-    s = db.query(models.Spreadsheet).filter(models.Spreadsheet.id == spreadsheet_id).first()
-    if not s:
-        raise HTTPException(status_code=404, detail="Not found")
-
-    if not user.is_admin:
-        user_access_ids = {level.id for level in user.access_levels}
-        if not _has_required_access(s, user_access_ids):
-            raise HTTPException(status_code=403, detail="Forbidden")
-
-    if not os.path.exists(s.file_path):
-        raise HTTPException(status_code=404, detail="File missing")
-
-    ext = os.path.splitext(s.file_path)[1].lower()
-    if ext == ".csv":
-        df = pd.read_csv(s.file_path)
+    s = _get_accessible_spreadsheet(db, spreadsheet_id, user)
+    # A blank search is no search
+    search = (search or "").strip() or None
+    audit.record(user.id, s.id, "view", search)
+    if search and match != "contains":
+        if not col:
+            raise HTTPException(status_code=400, detail=f"match={match} requires col")
+        # Resolved from the header, the sheet and its index are only loaded by the admitted task
+        col = _resolve_column(read_columns(s.file_path), col)
+        # Index lookups only touch the matching rows
+        cost = estimate_cost(s.file_path)
     else:
-        df = pd.read_excel(s.file_path)
+        cost = estimate_cost(s.file_path, search, col)
+    # A new search from the same user on the same sheet supersedes the previous keystroke
+    supersede_key = (user.id, spreadsheet_id) if search else None
 
-    if search:
-        if col and col in df.columns:
-            mask = df[col].astype(str).str.contains(search, case=False, na=False)
-        else:
-            mask = df.astype(str).apply(lambda row: row.str.contains(search, case=False, na=False)).any(axis=1)
-        df = df[mask]
-
-    df = df.iloc[offset:offset + limit]
-    for column in df.columns:
-        if _is_currency_column(column):
-            df[column] = df[column].apply(_format_brl)
-    # sanitize to JSON-safe values
-    df = df.replace({np.inf: None, -np.inf: None, np.nan: None})
+    with admission.admit(user.id, cost, supersede_key) as ticket:
+        # Superseded searches can only be interrupted when they run in this process
+        checkpoint = None if processing.enabled() else (lambda: admission.checkpoint(ticket))
+        page = processing.run(_build_data_page, s.file_path, offset, limit, search, col, checkpoint, match)
+        admission.checkpoint(ticket)
+        return page
+
+@router.get("/{spreadsheet_id}/schema")
+def get_spreadsheet_schema(
+    spreadsheet_id: int,
+    db: Session = Depends(get_db),
+    user=Depends(get_current_user),
+):
+    s = _get_accessible_spreadsheet(db, spreadsheet_id, user)
+    stats = column_stats.load(s.file_path)
+    if stats is None:
+        # Spreadsheets ingested before statistics existed are computed once here
+        with admission.admit(user.id, estimate_cost(s.file_path)):
+            stats = processing.run(column_stats.ensure, s.file_path)
     return {
-        "columns": list(df.columns),
-        "rows": df.to_dict(orient="records"),
+        "row_count": stats["row_count"],
+        "columns": [{**c, "currency": _is_currency_column(c["name"])} for c in stats["columns"]],
     }
 
+@router.get("/{spreadsheet_id}/aggregate")
+def aggregate_spreadsheet(
+    spreadsheet_id: int,
+    metrics: str = Query("count"),
+    group_by: str | None = None,
+    db: Session = Depends(get_db),
+    user=Depends(get_current_user),
+):
+    s = _get_accessible_spreadsheet(db, spreadsheet_id, user)
+    audit.record(user.id, s.id, "aggregate", metrics)
+    # Names are resolved from the header, the sheet itself is only loaded by the admitted task
+    columns = read_columns(s.file_path)
+    group_columns = list(dict.fromkeys(
+        _resolve_column(columns, name) for name in (group_by or "").split(",") if name.strip()
+    ))
+    metric_specs = _parse_metrics(metrics, columns)
+    labels = {_metric_label(func, column) for func, column in metric_specs}
+    for column in group_columns:
+        # Both end up as columns of the result
+        if column in labels:
+            raise HTTPException(status_code=400, detail=f"Column {column} conflicts with a metric")
+
+    with admission.admit(user.id, estimate_cost(s.file_path)):
+        return memoize(
+            s.file_path,
+            ("aggregate", tuple(group_columns), tuple(metric_specs)),
+            lambda: processing.run(_aggregate, s.file_path, group_columns, metric_specs),
+        )
+
 @router.get("/{spreadsheet_id}/download")
 def download_spreadsheet(
     spreadsheet_id: int,
@@ -133,17 +496,8 @@ def download_spreadsheet(
     db: Session = Depends(get_db),
     user=Depends(get_current_user),
 ):
-    s = db.query(models.Spreadsheet).filter(models.Spreadsheet.id == spreadsheet_id).first()
-    if not s:
-        raise HTTPException(status_code=404, detail="Not found")
-
-    if not user.is_admin:
-        user_access_ids = {level.id for level in user.access_levels}
-        if not _has_required_access(s, user_access_ids):
-            raise HTTPException(status_code=403, detail="Forbidden")
-
-    if not os.path.exists(s.file_path):
-        raise HTTPException(status_code=404, detail="File missing")
+    s = _get_accessible_spreadsheet(db, spreadsheet_id, user)
+    audit.record(user.id, s.id, "download", format)
 
     if format == "excel":
         filename = f"{s.title}.xlsx"
@@ -154,7 +508,39 @@ def download_spreadsheet(
     if ext == ".csv":
         return FileResponse(s.file_path, media_type="text/csv", filename=f"{s.title}.csv")
 
-    df = pd.read_excel(s.file_path)
-    temp_csv = os.path.join(os.path.dirname(s.file_path), f"{s.id}_temp.csv")
-    df.to_csv(temp_csv, index=False)
-    return FileResponse(temp_csv, media_type="text/csv", filename=f"{s.title}.csv")
+    # Converted chunk by chunk while sending, nothing is written next to the uploads.
+    # Only the conversion does real work, so only it is admitted; the ticket is held
+    # until the last chunk is sent.
+    admitted = admission.admit(user.id, estimate_cost(s.file_path))
+    admitted.__enter__()
+    chunks = iter_dataframe_chunks(s.file_path)
+    return StreamingResponse(
+        _release_when_done(_stream_csv(chunks), admitted),
+        media_type="text/csv",
+        headers=_attachment_headers(f"{s.title}.csv"),
+    )
+
+
+@router.get("/{spreadsheet_id}/export")
+def export_spreadsheet(
+    spreadsheet_id: int,
+    search: str | None = None,
+    col: str | None = None,
+    format: str = Query("csv", pattern="^(csv|ndjson|xlsx)$"),
+    db: Session = Depends(get_db),
+    user=Depends(get_current_user),
+):
+    s = _get_accessible_spreadsheet(db, spreadsheet_id, user)
+    audit.record(user.id, s.id, "export", f"{format} {search}" if search else format)
+    # The response body is produced after the DB session is closed, so only plain values are captured
+    chunks = _iter_filtered_chunks(s.file_path, search, col)
+
+    if format == "csv":
+        return StreamingResponse(_stream_csv(chunks), media_type="text/csv", headers=_attachment_headers(f"{s.title}.csv"))
+    if format == "ndjson":
+        return StreamingResponse(_stream_ndjson(chunks), media_type="application/x-ndjson", headers=_attachment_headers(f"{s.title}.ndjson"))
+    return StreamingResponse(
+        _stream_xlsx(chunks),
+        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        headers=_attachment_headers(f"{s.title}.xlsx"),
+    )
@@ -1,4 +1,5 @@
 from pydantic import BaseModel
+from datetime import datetime
 from typing import List, Optional
 
 class Token(BaseModel):
@@ -25,6 +26,11 @@ class UserCreate(BaseModel):
 class UserAccessUpdate(BaseModel):
     access_level_ids: List[int]
 
+class AccessLevelBulkFilter(BaseModel):
+    uf: Optional[str] = None
+    access_level_id: Optional[int] = None
+    cnpjs: Optional[List[str]] = None
+
 class UserItem(BaseModel):
     id: int
     cnpj: str
@@ -70,3 +76,18 @@ class PasswordResetConfirm(BaseModel):
     email: str
     code: str
     new_password: str
+
+class AuditEventItem(BaseModel):
+    id: int
+    user_id: int
+    user_cnpj: Optional[str] = None
+    spreadsheet_id: int
+    spreadsheet_title: Optional[str] = None
+    action: str
+    detail: Optional[str] = None
+    created_at: datetime
+
+class AuditPage(BaseModel):
+    offset: int
+    limit: int
+    items: List[AuditEventItem]
@@ -0,0 +1,130 @@
+import unicodedata
+from typing import TYPE_CHECKING
+import os
+from app.datasets import SEARCH_SUFFIX, load_dataframe, load_derived_frame, memoize, save_derived_frame, sidecar_path
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+
+# Searches run against a shadow copy of each spreadsheet where every cell is NFKD
+# normalized, stripped of accents and lowercased. It is built once per file version and
+# stored next to the parsed data, so "sao paulo" finds "São Paulo" without normalizing
+# any cell at request time.
+
+
+def normalize_text(text: str) -> str:
+    base = unicodedata.normalize("NFKD", str(text))
+    return "".join(ch for ch in base if not unicodedata.combining(ch)).lower()
+
+
+def split_terms(query: str) -> list[str]:
+    return normalize_text(query).split()
+
+
+def normalize_series(series: "pd.Series") -> "pd.Series":
+    import numpy as np
+    import pandas as pd
+
+    # Normalizes each distinct value once; missing cells become empty text
+    codes, uniques = pd.factorize(series)
+    lookup = np.array([normalize_text(value) for value in uniques] + [""], dtype=object)
+    return pd.Series(lookup[codes], index=series.index, dtype="string[pyarrow]")
+
+
+def build(df: "pd.DataFrame") -> "pd.DataFrame":
+    import pandas as pd
+
+    return pd.DataFrame({column: normalize_series(df[column]) for column in df.columns}, index=df.index)
+
+
+def load(file_path: str) -> "pd.DataFrame":
+    return load_derived_frame(file_path, SEARCH_SUFFIX, build)
+
+
+def extend(old_path: str, new_path: str) -> "pd.DataFrame":
+    """Shadow of ``new_path``, which is ``old_path`` plus appended rows, normalizing only those rows."""
+    import pandas as pd
+
+    if not os.path.exists(sidecar_path(old_path, SEARCH_SUFFIX)):
+        return load(new_path)
+    previous = load(old_path)
+    old_df = load_dataframe(old_path)
+    df = load_dataframe(new_path)
+    if len(previous) > len(df) or list(previous.columns) != [str(c) for c in df.columns]:
+        return load(new_path)
+    # The appended rows are taken from the new frame, so they are typed like the rest of it
+    appended = build(df.iloc[len(previous):])
+    appended.columns = previous.columns
+    shadow = pd.concat([previous, appended], ignore_index=True)
+    for position, column in enumerate(df.columns):
+        if df[column].dtype.kind != old_df.iloc[:, position].dtype.kind:
+            # The appended rows changed the column type (1 became 1.0), so its text changed too
+            shadow.iloc[:, position] = normalize_series(df[column]).to_numpy()
+    save_derived_frame(new_path, SEARCH_SUFFIX, shadow)
+    return load(new_path)
+
+
+def matches(shadow: "pd.DataFrame", terms: list[str], col: str | None = None, checkpoint=None) -> "pd.Series":
+    """Rows where every term appears in ``col``, or in any column when ``col`` is not given."""
+    import pandas as pd
+
+    columns = [col] if col is not None else list(shadow.columns)
+    mask = pd.Series(True, index=shadow.index)
+    for term in terms:
+        term_mask = pd.Series(False, index=shadow.index)
+        for column in columns:
+            if checkpoint:
+                checkpoint()
+            term_mask |= shadow[column].str.contains(term, regex=False).fillna(False).astype(bool)
+        mask &= term_mask
+    return mask
+
+
+# Exact and prefix lookups on one column use indexes over its shadow text, built on first
+# use and cached per file version: a hash map from value to row positions for exact
+# matches and the values sorted once for binary search of prefixes.
+
+def _index_keys(file_path: str, col: str) -> "np.ndarray":
+    return load(file_path)[col].str.strip().to_numpy(dtype=object, na_value="")
+
+
+def _exact_index(file_path: str, col: str) -> dict:
+    def build():
+        import numpy as np
+        import pandas as pd
+
+        keys = _index_keys(file_path, col)
+        return pd.Series(np.arange(len(keys))).groupby(keys, sort=False).indices
+
+    return memoize(file_path, ("exact_index", col), build)
+
+
+def _prefix_index(file_path: str, col: str) -> tuple["np.ndarray", "np.ndarray"]:
+    def build():
+        import numpy as np
+
+        keys = _index_keys(file_path, col)
+        order = np.argsort(keys, kind="stable")
+        return keys[order], order
+
+    return memoize(file_path, ("prefix_index", col), build)
+
+
+def lookup(file_path: str, col: str, query: str, mode: str) -> "np.ndarray":
+    """Positions, in sheet order, of the rows whose ``col`` equals or starts with ``query``."""
+    import numpy as np
+
+    key = normalize_text(query).strip()
+    if not key:
+        # Nothing left to match, like a contains search without terms
+        return np.arange(len(load(file_path)))
+    if mode == "exact":
+        positions = _exact_index(file_path, col).get(key, np.empty(0, dtype=np.intp))
+    else:
+        keys, order = _prefix_index(file_path, col)
+        # Every string starting with key sorts between key and key followed by the highest code point
+        start = np.searchsorted(keys, key, side="left")
+        end = np.searchsorted(keys, key + "\U0010ffff", side="left")
+        positions = order[start:end]
+    return np.sort(positions)
@@ -0,0 +1,170 @@
+import fcntl
+import hashlib
+import itertools
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from app import models
+from app.core.config import settings
+from app.datasets import evict
+from app.db import SessionLocal
+
+BLOCK_SIZE = 1024 * 1024
+TEMP_PREFIX = ".part-"
+
+# Uploads are stored as {sha256}{ext}. Several spreadsheets may point at the same blob,
+# and the number of spreadsheets rows referencing a path is its reference count.
+#
+# A new spreadsheet row is committed only after its blob is published, so a blob reused
+# by an upload can have no reference for a moment. Each publish leaves a marker file in
+# PUBLISHING_DIR, written under the same lock release() takes, until the caller has
+# committed its row (publish_done); release() keeps blobs that have a marker.
+PUBLISHING_DIR = ".publishing"
+
+_markers: dict[str, list[str]] = {}
+_markers_lock = threading.Lock()
+_marker_ids = itertools.count(1)
+
+
+@contextmanager
+def blob_lock():
+    """Serializes publishing and removing blobs across threads and worker processes."""
+    os.makedirs(settings.upload_dir, exist_ok=True)
+    with open(os.path.join(settings.upload_dir, ".blobs.lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def _blob_path(digest: str, ext: str) -> str:
+    return os.path.join(settings.upload_dir, f"{digest}{ext}")
+
+
+def _remove(file_path: str) -> None:
+    try:
+        os.remove(file_path)
+    except OSError:
+        pass
+
+
+def _publishing_dir() -> str:
+    return os.path.join(settings.upload_dir, PUBLISHING_DIR)
+
+
+def pending_publishes(file_path: str) -> int:
+    """Number of publishes of ``file_path`` whose spreadsheet row is not committed yet."""
+    prefix = f"{os.path.basename(file_path)}."
+    try:
+        return sum(1 for name in os.listdir(_publishing_dir()) if name.startswith(prefix))
+    except FileNotFoundError:
+        return 0
+
+
+def _publish(temp_path: str, digest: str, ext: str) -> str:
+    file_path = _blob_path(digest, ext)
+    os.makedirs(_publishing_dir(), exist_ok=True)
+    marker = os.path.join(_publishing_dir(), f"{digest}{ext}.{os.getpid()}.{next(_marker_ids)}")
+    with blob_lock():
+        open(marker, "w").close()
+        if os.path.exists(file_path):
+            _remove(temp_path)
+            # Refreshed so the reconciler also waits its grace period
+            os.utime(file_path)
+        else:
+            os.replace(temp_path, file_path)
+    with _markers_lock:
+        _markers.setdefault(file_path, []).append(marker)
+    return file_path
+
+
+def publish_done(file_path: str) -> None:
+    """Lets release() remove ``file_path`` again, once the row pointing at it is committed or abandoned."""
+    with _markers_lock:
+        markers = _markers.get(file_path)
+        if not markers:
+            return
+        marker = markers.pop()
+        if not markers:
+            del _markers[file_path]
+    _remove(marker)
+
+
+def store_stream(stream, ext: str) -> str:
+    """Copies ``stream`` into the upload directory and returns its content-addressed path."""
+    os.makedirs(settings.upload_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    fd, temp_path = tempfile.mkstemp(dir=settings.upload_dir, prefix=TEMP_PREFIX, suffix=ext)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while block := stream.read(BLOCK_SIZE):
+                digest.update(block)
+                f.write(block)
+        return _publish(temp_path, digest.hexdigest(), ext)
+    except BaseException:
+        _remove(temp_path)
+        raise
+
+
+def new_temp_path(ext: str) -> str:
+    os.makedirs(settings.upload_dir, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=settings.upload_dir, prefix=TEMP_PREFIX, suffix=ext)
+    os.close(fd)
+    return temp_path
+
+
+def store_file(temp_path: str, ext: str) -> str:
+    """Moves a file written with ``new_temp_path`` to its content-addressed path."""
+    digest = hashlib.sha256()
+    with open(temp_path, "rb") as f:
+        while block := f.read(BLOCK_SIZE):
+            digest.update(block)
+    return _publish(temp_path, digest.hexdigest(), ext)
+
+
+def reference_count(db: Session, file_path: str) -> int:
+    return (
+        db.query(func.count(models.Spreadsheet.id))
+        .filter(models.Spreadsheet.file_path == file_path)
+        .scalar()
+    )
+
+
+def release(db: Session, file_path: str | None) -> bool:
+    """Removes the blob and its derived data once no spreadsheet points at it."""
+    if not file_path:
+        return False
+    with blob_lock():
+        # Reused by an upload whose row is not committed yet
+        if pending_publishes(file_path) or reference_count(db, file_path):
+            return False
+        evict(file_path)
+        _remove(file_path)
+    return True
+
+
+def discard(db: Session, file_path: str) -> bool:
+    """Removes a blob just published by the caller and rejected before any row pointed at it."""
+    with blob_lock():
+        # The caller's own marker is still there
+        if pending_publishes(file_path) > 1 or reference_count(db, file_path):
+            return False
+        evict(file_path)
+        _remove(file_path)
+    return True
+
+
+def _release_detached(file_path: str) -> None:
+    db = SessionLocal()
+    try:
+        release(db, file_path)
+    finally:
+        db.close()
+
+
+def release_later(file_path: str) -> None:
+    """Releases a superseded version once readers that already resolved its path are done."""
+    timer = threading.Timer(settings.retired_file_grace_seconds, _release_detached, args=(file_path,))
+    timer.daemon = True
+    timer.start()
@@ -0,0 +1,120 @@
+import json
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from fastapi.responses import JSONResponse
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Durations of the named stages of the current request, in milliseconds. The dict is
+# shared with the threads FastAPI runs sync handlers in, which copy the context. When
+# timing is off nothing is set and stage() does no work.
+_current: ContextVar[dict | None] = ContextVar("request_timing", default=None)
+
+
+def enabled() -> bool:
+    return settings.server_timing or settings.slow_request_ms > 0
+
+
+@contextmanager
+def stage(name: str):
+    timing = _current.get()
+    if timing is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = (time.perf_counter() - started) * 1000
+        timing["stages"][name] = timing["stages"].get(name, 0.0) + elapsed
+
+
+def count(name: str, value: int) -> None:
+    timing = _current.get()
+    if timing is not None:
+        timing["counts"][name] = timing["counts"].get(name, 0) + value
+
+
+def recording() -> bool:
+    return _current.get() is not None
+
+
+@contextmanager
+def collect(enabled: bool = True):
+    """Records stages into a fresh dict, for work done outside the request, such as in a pool child."""
+    timing = {"stages": {}, "counts": {}} if enabled else None
+    token = _current.set(timing)
+    try:
+        yield timing
+    finally:
+        _current.reset(token)
+
+
+def merge(other: dict | None) -> None:
+    """Adds stages and counts recorded with collect() to the current request."""
+    timing = _current.get()
+    if timing is None or other is None:
+        return
+    for name, duration in other["stages"].items():
+        timing["stages"][name] = timing["stages"].get(name, 0.0) + duration
+    for name, value in other["counts"].items():
+        timing["counts"][name] = timing["counts"].get(name, 0) + value
+
+
+class TimedJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        with stage("encode"):
+            return super().render(content)
+
+
+def _header(stages: dict, total: float) -> bytes:
+    metrics = [f"{name};dur={duration:.1f}" for name, duration in stages.items()]
+    metrics.append(f"total;dur={total:.1f}")
+    return ", ".join(metrics).encode("latin-1")
+
+
+class ServerTimingMiddleware:
+    """Adds a Server-Timing header with the stage durations and logs slow requests."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not enabled():
+            await self.app(scope, receive, send)
+            return
+
+        timing = {"stages": {}, "counts": {}}
+        token = _current.set(timing)
+        started = time.perf_counter()
+        response_status = None
+
+        async def send_with_timing(message):
+            nonlocal response_status
+            if message["type"] == "http.response.start":
+                response_status = message["status"]
+                if settings.server_timing:
+                    total = (time.perf_counter() - started) * 1000
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", _header(dict(timing["stages"]), total)))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+            total = (time.perf_counter() - started) * 1000
+            if 0 < settings.slow_request_ms <= total:
+                logger.warning("slow request %s", json.dumps({
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "query": scope.get("query_string", b"").decode("latin-1"),
+                    "status": response_status,
+                    "total_ms": round(total, 1),
+                    "stages_ms": {name: round(duration, 1) for name, duration in timing["stages"].items()},
+                    **timing["counts"],
+                }))
@@ -0,0 +1,47 @@
+import logging
+import os
+import threading
+from app import models
+from app.core.config import settings
+from app.datasets import load_dataframe, popular_paths
+from app.db import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+state = {"status": "idle", "loaded": 0, "total": 0}
+
+
+def is_ready() -> bool:
+    return state["status"] in ("idle", "ready")
+
+
+def _warm_up(limit: int) -> None:
+    try:
+        db = SessionLocal()
+        try:
+            paths = [p for (p,) in db.query(models.Spreadsheet.file_path).all()]
+        finally:
+            db.close()
+        paths = [p for p in popular_paths(paths, limit) if os.path.exists(p)]
+        state["total"] = len(paths)
+        for file_path in paths:
+            try:
+                load_dataframe(file_path)
+            except Exception:
+                logger.exception("Warm-up failed for %s", file_path)
+            state["loaded"] += 1
+    finally:
+        state["status"] = "ready"
+
+
+def start_warmup() -> None:
+    """Preloads the most requested spreadsheets in the background."""
+    if settings.warmup_spreadsheets <= 0:
+        return
+    state["status"] = "warming"
+    threading.Thread(
+        target=_warm_up,
+        args=(settings.warmup_spreadsheets,),
+        name="dataset-warmup",
+        daemon=True,
+    ).start()
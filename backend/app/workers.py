@@ -0,0 +1,83 @@
+import json
+import os
+import resource
+import threading
+import time
+from app.core.config import settings
+from app import datasets
+
+# Every app worker process writes a small heartbeat file so any of them can report the
+# memory of all the others.
+
+
+def _stats_dir() -> str:
+    return os.path.join(settings.parsed_dir, "workers")
+
+
+def memory_usage() -> dict:
+    try:
+        with open("/proc/self/statm") as f:
+            fields = f.read().split()
+        page_size = os.sysconf("SC_PAGE_SIZE")
+        rss = int(fields[1]) * page_size
+        shared = int(fields[2]) * page_size
+    except (OSError, IndexError, ValueError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        shared = None
+    return {"rss_bytes": rss, "shared_bytes": shared}
+
+
+def write_heartbeat() -> None:
+    os.makedirs(_stats_dir(), exist_ok=True)
+    stats = {
+        "pid": os.getpid(),
+        "cached_frames": datasets.sweep(),
+        "updated_at": time.time(),
+        **memory_usage(),
+    }
+    path = os.path.join(_stats_dir(), f"{os.getpid()}.json")
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(stats, f)
+    os.replace(temp_path, path)
+
+
+def _heartbeat_loop() -> None:
+    while True:
+        try:
+            write_heartbeat()
+            datasets.flush_hits()
+        except OSError:
+            pass
+        time.sleep(settings.worker_heartbeat_seconds)
+
+
+def start_heartbeat() -> None:
+    threading.Thread(target=_heartbeat_loop, name="worker-heartbeat", daemon=True).start()
+
+
+def read_worker_stats() -> list[dict]:
+    stale_before = time.time() - 3 * settings.worker_heartbeat_seconds
+    workers = []
+    try:
+        names = os.listdir(_stats_dir())
+    except FileNotFoundError:
+        return workers
+    for name in names:
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(_stats_dir(), name)
+        try:
+            with open(path) as f:
+                stats = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if stats.get("updated_at", 0) < stale_before:
+            # Worker exited or was recycled
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        workers.append(stats)
+    return sorted(workers, key=lambda w: w["pid"])
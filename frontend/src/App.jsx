@@ -195,7 +195,9 @@ export default function App() {
       });
       setTable(res.data);
       if (reset) setOffset(0);
-    } catch {
+    } catch (err) {
+      // 409: a newer search replaced this one while it was running
+      if (err?.response?.status === 409) return;
       setError("Erro ao carregar dados da planilha.");
     }
   }
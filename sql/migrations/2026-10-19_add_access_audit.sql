@@ -0,0 +1,11 @@
+CREATE TABLE access_audit (
+  id BIGINT AUTO_INCREMENT PRIMARY KEY,
+  user_id INT NOT NULL,
+  spreadsheet_id INT NOT NULL,
+  action VARCHAR(20) NOT NULL,
+  detail VARCHAR(255),
+  created_at DATETIME NOT NULL,
+  INDEX ix_access_audit_user_id (user_id),
+  INDEX ix_access_audit_spreadsheet_id (spreadsheet_id),
+  INDEX ix_access_audit_created_at (created_at)
+);
@@ -0,0 +1,2 @@
+ALTER TABLE spreadsheets
+ADD COLUMN version INT NOT NULL DEFAULT 1 AFTER file_path;
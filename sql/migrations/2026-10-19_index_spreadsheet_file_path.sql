@@ -0,0 +1 @@
+CREATE INDEX ix_spreadsheets_file_path ON spreadsheets (file_path);
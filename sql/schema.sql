@@ -35,8 +35,10 @@ CREATE TABLE spreadsheets (
   id INT AUTO_INCREMENT PRIMARY KEY,
   title VARCHAR(150) NOT NULL,
   file_path VARCHAR(255) NOT NULL,
+  version INT NOT NULL DEFAULT 1,
   uploaded_by INT NOT NULL,
   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  INDEX ix_spreadsheets_file_path (file_path),
   FOREIGN KEY (uploaded_by) REFERENCES users(id)
 );
 
@@ -48,6 +50,18 @@ CREATE TABLE spreadsheet_access (
   FOREIGN KEY (access_level_id) REFERENCES access_levels(id) ON DELETE CASCADE
 );
 
+CREATE TABLE access_audit (
+  id BIGINT AUTO_INCREMENT PRIMARY KEY,
+  user_id INT NOT NULL,
+  spreadsheet_id INT NOT NULL,
+  action VARCHAR(20) NOT NULL,
+  detail VARCHAR(255),
+  created_at DATETIME NOT NULL,
+  INDEX ix_access_audit_user_id (user_id),
+  INDEX ix_access_audit_spreadsheet_id (spreadsheet_id),
+  INDEX ix_access_audit_created_at (created_at)
+);
+
 INSERT INTO access_levels (name) VALUES
 ('Deep dive Legend'),
 ('Deep dive Infinite'),